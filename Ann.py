@@ -1,11 +1,27 @@
 import os
-import glob
+import json
+import struct
+import fnmatch
+import threading
+import collections
+import heapq
+import sqlite3
+import zipfile
 import numpy
 import scipy
 
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
+# os.scandir is in Python 3.5+, the scandir package provides it for older versions
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 # whole image annotation labels
 LPOS, LNEG, LSKIP = 1, -1, 0
 
@@ -31,17 +47,158 @@ V0, V1, V2, V3 = 0, 1, 2, 3
 # STS: in the test set
 S0, STR, STS = 0, 1, -1
 
+# annotation manifest: cached image list and per image info, saved in the annotation directory
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# annotation storage backend of new annotation directories: 'files' (a .labels.txt file per image and
+# a .png mask per object, see FileStore) or 'sqlite' (a single database file, see SQLiteStore);
+# a directory containing ANNOTATION_DB is always opened with the SQLite backend
+ANNOTATION_STORE = 'files'
+ANNOTATION_DB = 'annotations.db'
+
+# directory (in the annotation directory) of the object regions saved by RegionCache
+REGION_CACHE_DIR = 'regions/'
+
+# directory (in the annotation directory) of the columnar box index, see BoxIndex
+BOX_INDEX_DIR = 'boxindex/'
+
+# number of threads decoding the object masks of an image when it is opened
+MASK_LOAD_THREADS = 4
+
+# object mask file format of FileStore: 'png' (8 bit PNG), 'npy' (numpy uint8 array, fast, large) or
+# 'bits' (packed bits: width and height as 32 bit little endian integers, then a bit per pixel, row major);
+# the masks in the other formats are still read
+MASK_CODEC = 'png'
+MASK_EXTENSIONS = {'png': '.png', 'npy': '.npy', 'bits': '.bits'}
+# zlib compression level of the PNG masks, 0 (fastest, largest) to 9 (slowest, smallest), -1: Qt default
+MASK_COMPRESSION = -1
+# number of threads encoding the object masks being saved
+MASK_SAVE_THREADS = 4
+
+# number of image file names sent at once to the GUI while scanning a directory
+SCAN_BATCH = 500
+
+# Run-length encoded binary mask, compatible with the COCO RLE format:
+# the pixels are scanned in column-major order and counts[] alternates between
+# runs of 0s and 1s, always starting with a (possibly empty) run of 0s
+class RLEMask(object):
+    __slots__ = ('w', 'h', 'counts')
+    
+    def __init__(self, w=0, h=0, counts=None):
+        self.w, self.h = w, h
+        if counts is None: counts = [w*h]
+        self.counts = numpy.asarray(counts, numpy.int64)
+    
+    # encode a boolean/uint8 (h, w) array, nonzero pixels are foreground
+    @staticmethod
+    def fromArray(arr):
+        h, w = arr.shape
+        flat = (arr != 0).ravel(order='F').view(numpy.uint8)
+        if flat.size == 0: return RLEMask(w, h, [])
+        change = numpy.flatnonzero(flat[1:] != flat[:-1]) + 1
+        counts = numpy.diff(numpy.concatenate(([0], change, [flat.size])))
+        if flat[0]: counts = numpy.concatenate(([0], counts))
+        return RLEMask(w, h, counts)
+    # encode a mask image (e.g., alphaChannel() of the painting), pixels with nonzero color are foreground
+    @staticmethod
+    def fromQImage(qimage):
+        return RLEMask.fromArray(foregroundPixels(qimage))
+    
+    # decode to a (h, w) uint8 array with values 0/255
+    def toArray(self):
+        values = numpy.arange(len(self.counts), dtype=numpy.uint8) % 2 * 255
+        flat = numpy.repeat(values, self.counts)
+        return flat.reshape(self.w, self.h).T
+    # decode to an 8 bit grayscale image, in the same format as QImage.alphaChannel()
+    def toQImage(self):
+        qimage = QImage(self.w, self.h, QImage.Format_Indexed8)
+        qimage.setColorTable([qRgb(i, i, i) for i in range(256)])
+        if self.w > 0 and self.h > 0:
+            qimage2numpy(qimage, True)[:] = self.toArray()
+        return qimage
+    
+    # number of foreground pixels
+    def area(self):
+        return int(self.counts[1::2].sum())
+    # [x, y, w, h] of the foreground pixels, computed on the runs; [0, 0, 0, 0] if empty
+    def bbox(self):
+        ends = numpy.cumsum(self.counts)
+        starts = ends[0::2][:len(self.counts)//2]
+        ends = ends[1::2] - 1
+        keep = ends >= starts
+        starts, ends = starts[keep], ends[keep]
+        if len(starts) == 0: return [0, 0, 0, 0]
+        xs, xe = starts // self.h, ends // self.h
+        ys = numpy.where(xs == xe, starts % self.h, 0)
+        ye = numpy.where(xs == xe, ends % self.h, self.h-1)
+        x1, y1 = int(xs.min()), int(ys.min())
+        return [x1, y1, int(xe.max())-x1+1, int(ye.max())-y1+1]
+    # [start, end) pixel intervals of the foreground runs
+    def intervals(self):
+        ends = numpy.cumsum(self.counts)
+        return ends[0::2][:len(self.counts)//2], ends[1::2]
+    # intersection over union with another mask of the same size, computed on the runs
+    def iou(self, other):
+        if (self.w, self.h) != (other.w, other.h): return 0.0
+        sa, ea = self.intervals()
+        sb, eb = other.intervals()
+        inter, i, j = 0, 0, 0
+        while i < len(sa) and j < len(sb):
+            inter += max(0, min(ea[i], eb[j]) - max(sa[i], sb[j]))
+            if ea[i] < eb[j]: i += 1
+            else: j += 1
+        union = self.area() + other.area() - inter
+        if union == 0: return 0.0
+        return float(inter) / union
+    
+    # COCO compressed RLE: {'size': [h, w], 'counts': string}
+    def toCOCO(self):
+        chars = []
+        for i in range(len(self.counts)):
+            x = int(self.counts[i])
+            if i > 2: x -= int(self.counts[i-2])
+            more = True
+            while more:
+                c = x & 0x1f
+                x >>= 5
+                if c & 0x10: more = x != -1
+                else: more = x != 0
+                if more: c |= 0x20
+                chars.append(chr(c + 48))
+        return {'size': [self.h, self.w], 'counts': ''.join(chars)}
+    @staticmethod
+    def fromCOCO(rle):
+        h, w = rle['size']
+        counts = rle['counts']
+        if not isinstance(counts, basestring): return RLEMask(w, h, counts)
+        cnts, p = [], 0
+        while p < len(counts):
+            x, k, more = 0, 0, True
+            while more:
+                c = ord(counts[p]) - 48
+                x |= (c & 0x1f) << 5*k
+                more = c & 0x20
+                p += 1; k += 1
+                if not more and (c & 0x10): x |= -1 << 5*k
+            if len(cnts) > 2: x += cnts[-2]
+            cnts.append(x)
+        return RLEMask(w, h, cnts)
+
 # One object selected by the user
-class Object:
+# (slotted, there may be millions of objects in memory)
+class Object(object):
+    __slots__ = ('region', 'x1', 'y1', 'w', 'h', 'mask', 'text', 'id', 'saveMask')
+    
     def __init__(self, mask=None, region=None, x1=0, y1=0, id=0, w=0, h=0, text=None ):
-        self.mask = mask
         self.region = region        
         self.x1, self.y1, self.w, self.h = x1, y1, w, h
-        self.text = text    # the label/name/text of this object
+        self.setMask(mask)
+        self.text = internLabel(text)   # the label/name/text of this object, UTF-8 str (QString only in the GUI)
         #if region:
         #    self.w, self.h = region.width(), region.height()
         self.id = id
-        self.saveMask = True
+        self.saveMask = mask is not None    # a new mask is to be saved, the masks read from the store are not
         #print 'Label for object ', id, self.text.toUtf8()
         
     def deleteMask(self):
@@ -49,77 +206,799 @@ class Object:
         m = self.mask
         self.mask = None
         del m
-    def loadObjectMask(self, fname, forceLoad=False):
+    # the mask is kept (and saved) cropped to the MBR (x1, y1, w, h) of the object,
+    # as an RLEMask in memory; a full image mask (old format) is cropped here
+    def setMask(self, mask):
+        if isinstance(mask, QImage):
+            if mask.width() != self.w or mask.height() != self.h:
+                mask = mask.copy(self.x1, self.y1, self.w, self.h)
+            mask = RLEMask.fromQImage(mask)
+        self.mask = mask
+    # the mask decoded as an 8 bit image, None if there is no mask
+    def maskImage(self):
+        if self.mask: return self.mask.toQImage()
+        return None
+    # mask: the mask image if already decoded from fname (e.g., prefetched), otherwise it is read from fname
+    # the mask is as saved in the store, so it is not saved again (unless changed)
+    def loadObjectMask(self, fname, forceLoad=False, mask=None):
         if self.mask and not forceLoad: return
-        if os.path.exists(fname):
-            self.mask = QImage(fname)
-            self.saveMask = True
+        if mask is not None:
+            self.setMask(mask)
+            self.saveMask = False
+        elif os.path.exists(fname):
+            self.setMask(QImage(fname))
+            self.saveMask = False
         else:
             self.mask = None
             print 'Error! Object mask file does not exist: ', fname         
-    def loadObjectImage(self, fname, brushColor, forceLoad=False):
+    def loadObjectImage(self, fname, brushColor, forceLoad=False, mask=None):
         if self.region and not forceLoad: return
-        if not self.mask: self.loadObjectMask(fname)
+        if not self.mask: self.loadObjectMask(fname, False, mask)
         if self.mask: self.region = self.getObjectRegion(brushColor)
         else:
             self.region = None
             print 'Could not load object image from mask file ', fname        
-    # the image region to be shown on the object list scene
+    # the image region to be shown on the object list scene: the brush color color-burned with the mask,
+    # i.e. the (burned) brush color on the object, opaque black elsewhere; composited with numpy
     def getObjectRegion(self, brushColor):
-        cmask = self.mask.copy(self.x1, self.y1, self.w, self.h)
         rqimg = QImage(self.w, self.h, QImage.Format_ARGB32_Premultiplied)
         rqimg.fill(brushColor.rgba())
-        painter = QPainter(rqimg) 
-        painter.setCompositionMode(QPainter.CompositionMode_ColorBurn)     
-        painter.drawImage(0,0,cmask)
-        painter.end()
+        if self.w > 0 and self.h > 0:
+            arr = qimage2numpy(rqimg, True)
+            fg = self.mask.toArray()[:self.h, :self.w] > 0
+            arr[:fg.shape[0], :fg.shape[1]] = numpy.where(fg, numpy.uint32(burnColor(brushColor)), numpy.uint32(0xff000000))
         return rqimg    
-    def save(self, fname):
-        if self.mask and self.saveMask:
-            if not self.mask.save(fname):
-                print 'Error saving object mask ', self.id, ' to ', fname                
-            print 'Object mask saved to ', fname
-            self.saveMask = False
+
+# Decodes an image and its object masks on a worker thread (QImage can be used outside the GUI thread)
+class PrefetchJob(QRunnable):
+    def __init__(self, imagePath, maskKeys, store=None):
+        super(PrefetchJob, self).__init__()
+        self.imagePath = imagePath
+        self.maskKeys = maskKeys        # masks to be read from 'store' (see Store.savedMasks)
+        self.store = store
+        self.image = None
+        self.masks = {}
+        self.started = False
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+    
+    def run(self):
+        with self.lock:
+            if self.cancelled:
+                self.done.set()
+                return
+            self.started = True
+        image = None
+        if self.imagePath: image = QImage(self.imagePath)
+        for key in self.maskKeys:
+            if self.cancelled: break
+            mask = self.store.readMask(key)
+            if mask is not None: self.masks[key] = mask
+        if image and not image.isNull(): self.image = image
+        self.done.set()
+    
+    # cancel the job (stop a running job too, if running); return True if it had not started yet
+    def cancel(self, running=True):
+        with self.lock:
+            if self.started and not running: return False
+            self.cancelled = True
+            return not self.started
+
+# Reads a part of the masks of an image from a store, for readMasks
+class MaskLoadJob(QRunnable):
+    def __init__(self, store, keys, masks):
+        super(MaskLoadJob, self).__init__()
+        self.setAutoDelete(False)
+        self.store = store
+        self.keys = keys
+        self.masks = masks          # key -> mask, shared by the jobs
+    
+    def run(self):
+        for key in self.keys:
+            mask = self.store.readMask(key)
+            if mask is not None: self.masks[key] = mask
+
+maskPool = None
+# read the masks 'keys' from 'store' with MASK_LOAD_THREADS threads (decoding a QImage releases the GIL)
+# return {key: mask} of the masks found
+def readMasks(store, keys):
+    global maskPool
+    masks = {}
+    if len(keys) < 2:
+        MaskLoadJob(store, keys, masks).run()
+        return masks
+    if maskPool is None:
+        maskPool = QThreadPool()
+        maskPool.setMaxThreadCount(MASK_LOAD_THREADS)
+    n = min(MASK_LOAD_THREADS, len(keys))
+    jobs = [MaskLoadJob(store, keys[i::n], masks) for i in range(n)]
+    for job in jobs:
+        maskPool.start(job)
+    maskPool.waitForDone()
+    return masks
+
+# Encodes a part of the masks being saved, for encodeMasks
+class MaskSaveJob(QRunnable):
+    def __init__(self, items, encoded):
+        super(MaskSaveJob, self).__init__()
+        self.setAutoDelete(False)
+        self.items = items          # [(file, mask)]
+        self.encoded = encoded      # the files written, shared by the jobs
+    
+    def run(self):
+        for fname, mask in self.items:
+            if encodeMask(fname + '.tmp', mask): self.encoded.add(fname)
+
+maskSavePool = None
+# encode the masks [(file, RLEMask)] to file + '.tmp' in MASK_CODEC with MASK_SAVE_THREADS threads
+# (PNG compression releases the GIL); return the set of the files written
+def encodeMasks(items):
+    global maskSavePool
+    encoded = set()
+    if len(items) < 2:
+        MaskSaveJob(items, encoded).run()
+        return encoded
+    if maskSavePool is None:
+        maskSavePool = QThreadPool()
+        maskSavePool.setMaxThreadCount(MASK_SAVE_THREADS)
+    n = min(MASK_SAVE_THREADS, len(items))
+    jobs = [MaskSaveJob(items[i::n], encoded) for i in range(n)]
+    for job in jobs:
+        maskSavePool.start(job)
+    maskSavePool.waitForDone()
+    return encoded
+
+# Decodes the images around the current one in the background, so that going to the next/previous image
+# does not wait for the image and its object masks to be read from the disk
+class ImagePrefetcher:
+    def __init__(self, depth=2, numThreads=2):
+        self.depth = depth          # number of images to prefetch before and after the current image
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(numThreads)
+        self.jobs = {}              # image path -> PrefetchJob
+    
+    def setDepth(self, depth):
+        self.depth = max(0, depth)
+    
+    # prefetch the images around image @index of the annotation, cancel the jobs for the other images
+    # the images already in 'cache' (ImageCache) are not decoded again, only their object masks
+    def prefetchAround(self, ann, index, cache=None):
+        indices = []
+        for d in range(1, self.depth+1):
+            indices += [i for i in (index+d, index-d) if 0 <= i < ann.numImages()]
+        files = [ann.prefetchFiles(i) for i in indices]
+        paths = set(path for path, masks in files)
+        for path in self.jobs.keys():
+            if path not in paths: self.jobs.pop(path).cancel()
+        for path, masks in files:
+            if path in self.jobs: continue
+            imagePath = path
+            if cache is not None and imageCacheKey(path) in cache:
+                if len(masks) == 0: continue
+                imagePath = None
+            job = PrefetchJob(imagePath, masks, ann.store)
+            self.jobs[path] = job
+            self.pool.start(job)
+    
+    # return (image, {mask key: mask}) for a prefetched image, waiting for it if it is being decoded
+    # (None, {}) if it was not prefetched
+    def take(self, path):
+        job = self.jobs.pop(path, None)
+        if job is None or job.cancel(False): return None, {}
+        job.done.wait()
+        return job.image, job.masks
+    
+    def cancel(self):
+        for job in self.jobs.values():
+            job.cancel()
+        self.jobs.clear()
+    
+    # cancel the pending jobs and wait for the running ones
+    def stop(self):
+        self.cancel()
+        self.pool.waitForDone()
+
+# Snapshot of the annotations of an image (labels and unsaved object masks), to be written to 'store'
+class SaveTask:
+    def __init__(self, ximg, store):
+        self.image = ximg
+        self.store = store
+        self.key = (store, ximg.fname)
+        self.labels = None
+        if len(ximg.objects) > 0: self.labels = ximg.labelRows()
+        self.masks = {}         # mask key -> (object, mask)
+        for obj in ximg.objects:
+            if obj.mask and obj.saveMask:
+                self.masks[store.maskKey(ximg, obj)] = (obj, obj.mask)
+    
+    # coalesce with a newer snapshot of the same image
+    def merge(self, task):
+        if task.labels is not None: self.labels = task.labels
+        self.masks.update(task.masks)
+    
+    # write the annotations; return the list of error messages
+    def run(self):
+        return self.store.write([self])
+
+# Annotations stored as files in the annotation directory: a .labels.txt file per image (the MBRs and
+# labels of its objects) and a mask file per object (see MASK_CODEC); the masks are identified by their
+# file path (in MASK_CODEC), the saved masks by the file found (see savedMasks)
+class FileStore:
+    def __init__(self, annotationDir):
+        self.annotationDir = annotationDir
+    
+    def close(self):
+        pass
+    
+    def labelsPath(self, fname):
+        return self.annotationDir + fname + ".labels.txt"
+    def maskKey(self, ximg, obj):
+        return ximg.maskPath(self.annotationDir, obj)
+    # key of the object region of a saved mask (a file of savedMasks) in an ImageCache
+    def cacheKey(self, fname, extra=None):
+        return imageCacheKey(fname, extra)
+    # the files a mask may be saved to (one per format), the one of MASK_CODEC first
+    def maskFiles(self, key):
+        base = os.path.splitext(key)[0]
+        exts = [MASK_EXTENSIONS[MASK_CODEC]] + [ext for codec, ext in sorted(MASK_EXTENSIONS.items()) if codec != MASK_CODEC]
+        return [base + ext for ext in exts]
+    
+    # names of the annotated images
+    def imageNames(self):
+        if not os.path.isdir(self.annotationDir): return []
+        n = len(".labels.txt")
+        return sortImageNames(f[:-n] for f in os.listdir(self.annotationDir) if f.endswith(".labels.txt"))
+    # version of the annotations of an image, to check a cached (manifest) copy; None if not annotated
+    def labelsStat(self, fname):
+        return fileStat(self.labelsPath(fname))
+    # (labelsStat, number of objects) of an image, without loading the objects
+    def countObjects(self, fname):
+        return countLabels(self.labelsPath(fname))
+    # load the objects (without their masks) of the image
+    def loadLabels(self, ximg):
+        ximg.loadTxtFile(self.annotationDir)
+    
+    # the saved masks of the objects of ximg, {mask key: file}, from one listing of the annotation directory
+    # for the image (instead of a stat per object and format; MASK_CODEC first if saved in several formats)
+    def savedMasks(self, ximg):
+        if len(ximg.objects) == 0: return {}
+        keys = [self.maskKey(ximg, obj) for obj in ximg.objects]
+        try:
+            names = set(os.listdir(os.path.dirname(keys[0])))
+        except OSError:
+            return {}
+        files = {}
+        for key in keys:
+            for fname in self.maskFiles(key):
+                if os.path.basename(fname) in names:
+                    files[key] = fname
+                    break
+        return files
+    # the mask (QImage or RLEMask) of a file of savedMasks, None on error
+    def readMask(self, fname):
+        return decodeMask(fname)
+    
+    # write the SaveTasks; return the list of error messages
+    def write(self, tasks):
+        errors = []
+        if not os.path.isdir(self.annotationDir):
+            print self.annotationDir, ' does not exist! create it..'
+            os.makedirs(self.annotationDir)        
+        # all the masks are encoded (to temporary files) in parallel first
+        encoded = encodeMasks([(self.maskFiles(key)[0], mask) for task in tasks for key, (obj, mask) in task.masks.items()])
+        for task in tasks:
+            for key, (obj, mask) in task.masks.items():
+                files = self.maskFiles(key)
+                fname = files[0]
+                try:
+                    if fname not in encoded: raise IOError
+                    replaceFile(fname + '.tmp', fname)
+                    for other in files[1:]:     # the mask saved in another format before
+                        if os.path.exists(other): os.remove(other)
+                except (IOError, OSError):
+                    errors.append('Error saving object mask ' + str(obj.id) + ' to ' + fname)
+                    continue
+                if obj.mask is mask: obj.saveMask = False
+                print 'Object mask saved to ', fname
+            if task.labels is not None:
+                labelsPath = self.labelsPath(task.image.fname)
+                try:
+                    writeFileAtomic(labelsPath, labelsText(task.image.fname, task.labels))
+                    task.image.labelsStat = fileStat(labelsPath)
+                    print 'Saved to:', labelsPath
+                except (IOError, OSError):
+                    errors.append('Could not save image annotation to ' + labelsPath)
+        return errors
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    revision INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS objects (
+    image INTEGER NOT NULL REFERENCES images(id),
+    id INTEGER NOT NULL,
+    x1 INTEGER, y1 INTEGER, w INTEGER, h INTEGER,
+    label TEXT,
+    mask_w INTEGER, mask_h INTEGER,
+    mask BLOB,
+    PRIMARY KEY (image, id)
+);
+CREATE INDEX IF NOT EXISTS objects_label ON objects(label);
+"""
+
+# Annotations stored in a single SQLite database in the annotation directory: the images (by name), their objects
+# (MBR and label, indexed by label) and the object masks (COCO compressed RLE); the masks are identified by
+# (image name, object id). The connection is shared by the GUI, the writer, scanner and prefetch threads.
+class SQLiteStore:
+    def __init__(self, annotationDir, dbfile=ANNOTATION_DB):
+        self.annotationDir = annotationDir
+        self.path = annotationDir + dbfile
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.text_factory = str          # labels are kept as UTF-8 strings
+        with self.lock:
+            self.db.executescript(SQLITE_SCHEMA)
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS kept_ids (id INTEGER PRIMARY KEY)')
+        self.info = None        # image name -> [image id, revision, number of objects], read at first use
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+    
+    def maskKey(self, ximg, obj):
+        return (ximg.fname, obj.id)
+    def cacheKey(self, key, extra=None):
+        revision = self.labelsStat(key[0])
+        if revision is None: return None
+        return (self.path, key, revision, extra)
+    
+    def imageInfo(self, fname):
+        with self.lock:
+            if self.info is None:
+                rows = self.db.execute('SELECT images.name, images.id, images.revision, COUNT(objects.id) FROM images '
+                                       'LEFT JOIN objects ON objects.image = images.id GROUP BY images.id')
+                self.info = dict((row[0], list(row[1:])) for row in rows)
+            return self.info.get(fname)
+    
+    def imageNames(self):
+        with self.lock:
+            rows = self.db.execute('SELECT name FROM images').fetchall()
+        return sortImageNames(row[0] for row in rows)
+    def labelsStat(self, fname):
+        info = self.imageInfo(fname)
+        if info is None: return None
+        return info[1]
+    def countObjects(self, fname):
+        info = self.imageInfo(fname)
+        if info is None: return None, 0
+        return info[1], info[2]
+    def loadLabels(self, ximg):
+        ximg.labelsKnown = True
+        if len(ximg.objects) > 0: return
+        ximg.nobjects = None
+        ximg.labelsStat = self.labelsStat(ximg.fname)
+        if ximg.labelsStat is None: return
+        with self.lock:
+            rows = self.db.execute('SELECT objects.id, x1, y1, w, h, label FROM objects JOIN images ON objects.image = images.id '
+                                   'WHERE images.name = ? ORDER BY objects.rowid', (ximg.fname,)).fetchall()
+        for id, x1, y1, w, h, label in rows:
+            ximg.appendObject(Object(None, None, x1, y1, id, w, h, label or ''))
+    
+    # (image name, object id) of the objects labeled 'label' (UTF-8)
+    def findLabel(self, label):
+        with self.lock:
+            return self.db.execute('SELECT images.name, objects.id FROM objects JOIN images ON objects.image = images.id '
+                                   'WHERE objects.label = ?', (label,)).fetchall()
+    
+    def maskRow(self, key):
+        with self.lock:
+            return self.db.execute('SELECT mask_w, mask_h, mask FROM objects JOIN images ON objects.image = images.id '
+                                   'WHERE images.name = ? AND objects.id = ?', key).fetchone()
+    # the saved masks of the objects of ximg, {mask key: mask key}, see FileStore.savedMasks
+    def savedMasks(self, ximg):
+        with self.lock:
+            rows = self.db.execute('SELECT objects.id FROM objects JOIN images ON objects.image = images.id '
+                                   'WHERE images.name = ? AND objects.mask IS NOT NULL', (ximg.fname,)).fetchall()
+        return dict(((ximg.fname, id), (ximg.fname, id)) for id, in rows)
+    def readMask(self, key):
+        row = self.maskRow(key)
+        if row is None or row[2] is None: return None
+        return RLEMask.fromCOCO({'size': [row[1], row[0]], 'counts': str(row[2])})
+    
+    # write the SaveTasks in one transaction; return the list of error messages
+    def write(self, tasks):
+        with self.lock:
+            try:
+                with self.db:
+                    revisions = [self.writeTask(task) for task in tasks]
+            except sqlite3.Error as e:
+                self.info = None
+                return ['Could not save annotations to ' + self.path + ': ' + str(e)]
+        for task, revision in zip(tasks, revisions):
+            for key, (obj, mask) in task.masks.items():
+                if obj.mask is mask: obj.saveMask = False
+            task.image.labelsStat = revision
+            print 'Saved to:', self.path, task.image.fname
+        return []
+    def writeTask(self, task):
+        db, name = self.db, task.image.fname
+        db.execute('INSERT OR IGNORE INTO images (name) VALUES (?)', (name,))
+        db.execute('UPDATE images SET revision = revision + 1 WHERE name = ?', (name,))
+        image, revision = db.execute('SELECT id, revision FROM images WHERE name = ?', (name,)).fetchone()
+        if task.labels is not None:
+            # the ids kept go through a temporary table, not one SQL variable each (at most 999 in older SQLite)
+            db.execute('DELETE FROM kept_ids')
+            db.executemany('INSERT OR IGNORE INTO kept_ids (id) VALUES (?)', [(row[0],) for row in task.labels])
+            db.execute('DELETE FROM objects WHERE image = ? AND id NOT IN (SELECT id FROM kept_ids)', (image,))
+            for id, x1, y1, w, h, label in task.labels:
+                if db.execute('UPDATE objects SET x1 = ?, y1 = ?, w = ?, h = ?, label = ? WHERE image = ? AND id = ?',
+                              (x1, y1, w, h, label, image, id)).rowcount == 0:
+                    db.execute('INSERT INTO objects (image, id, x1, y1, w, h, label) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (image, id, x1, y1, w, h, label))
+        for key, (obj, mask) in task.masks.items():
+            args = (mask.w, mask.h, sqlite3.Binary(mask.toCOCO()['counts']), image, obj.id)
+            if db.execute('UPDATE objects SET mask_w = ?, mask_h = ?, mask = ? WHERE image = ? AND id = ?', args).rowcount == 0:
+                db.execute('INSERT INTO objects (image, id, x1, y1, w, h, label, mask_w, mask_h, mask) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (image, obj.id, obj.x1, obj.y1, obj.w, obj.h, obj.text) + args[:3])
+        if self.info is not None:
+            count = db.execute('SELECT COUNT(*) FROM objects WHERE image = ?', (image,)).fetchone()[0]
+            self.info[name] = [image, revision, count]
+        return revision
+
+# Writes the annotations (SaveTask) on a background thread, in the order they are queued
+# a newer snapshot of an image still in the queue replaces (is merged into) the queued one
+# write errors are reported with the signal error(QString)
+class AnnotationWriter(QObject):
+    def __init__(self):
+        super(AnnotationWriter, self).__init__()
+        self.tasks = {}         # (store, image name) -> SaveTask (or RegionTask, the store being a RegionCache)
+        self.order = []         # task keys, in the order to write
+        self.active = []        # tasks being written
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def write(self, task):
+        with self.cond:
+            if task.key in self.tasks:
+                self.tasks[task.key].merge(task)
+            else:
+                self.tasks[task.key] = task
+                self.order.append(task.key)
+            self.cond.notify_all()
+    
+    # number of tasks queued or being written
+    def pending(self):
+        with self.cond:
+            return len(self.order) + len(self.active)
+    
+    # wait until a task is written (or timeout seconds)
+    def wait(self, timeout=None):
+        with self.cond:
+            if self.order or self.active: self.cond.wait(timeout)
+    
+    # the queued tasks are written together, in one batch (transaction) per store
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.order: self.cond.wait()
+                self.active = [self.tasks.pop(key) for key in self.order]
+                del self.order[:]
+            batches = collections.OrderedDict()
+            for task in self.active:
+                batches.setdefault(task.store, []).append(task)
+            errors = []
+            try:
+                for store, tasks in batches.items():
+                    # any error is reported, the writer thread must not die with tasks still active
+                    try:
+                        errors += store.write(tasks)
+                    except Exception as e:
+                        errors.append('Could not save ' + str(len(tasks)) + ' annotations: ' + str(e))
+            finally:
+                with self.cond:
+                    self.active = []
+                    self.cond.notify_all()
+            for message in errors:
+                self.emit(SIGNAL('error(QString)'), message)
+
+# Lists an image directory in a thread: the image file names are sent in batches ('found') as they
+# are found, then all of them sorted ('listed'); then the objects of the images are counted in the store,
+# in batches ('counted'), without parsing them, to fill the image list
+# entries: {image name: manifest entry} of the images already listed from an out of date manifest; then the
+# names found are not sent, and the objects are counted only for the images whose entry is out of date
+class DirectoryScanner(QObject):
+    def __init__(self, imageDir, fileExt, store, entries=None, batchSize=SCAN_BATCH):
+        super(DirectoryScanner, self).__init__()
+        self.imageDir, self.fileExt, self.store = imageDir, fileExt, store
+        self.entries = entries or {}
+        self.batchSize = batchSize
+        self.cancelled = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+    
+    def start(self):
+        self.thread.start()
+    def cancel(self):
+        self.cancelled = True
+    
+    def run(self):
+        names, batch = [], []
+        try:
+            for f in scanImages(self.imageDir, self.fileExt):
+                if self.cancelled: return
+                batch.append(f)
+                if len(batch) == self.batchSize:
+                    if not self.entries: self.emit(SIGNAL('found(PyQt_PyObject)'), batch)
+                    names += batch
+                    batch = []
+        except OSError as e:
+            self.emit(SIGNAL('error(QString)'), 'Could not list ' + self.imageDir + ': ' + str(e))
+        if batch and not self.entries: self.emit(SIGNAL('found(PyQt_PyObject)'), batch)
+        names = sortImageNames(names + batch)
+        if self.cancelled: return
+        self.emit(SIGNAL('listed(PyQt_PyObject)'), names)
+        
+        counts = []
+        for index, f in enumerate(names):
+            if self.cancelled: return
+            entry = self.entries.get(f)
+            if entry is not None and self.store.labelsStat(f) == entry['labels']: count = (entry['labels'], entry['objects'])
+            else: count = self.store.countObjects(f)
+            counts.append((index, fileStat(self.imageDir + f)) + count)
+            if len(counts) == self.batchSize:
+                self.emit(SIGNAL('counted(PyQt_PyObject)'), counts)
+                counts = []
+        if counts: self.emit(SIGNAL('counted(PyQt_PyObject)'), counts)
+        self.emit(SIGNAL('finished()'))
+
+# Least recently used cache of decoded images (QImage), limited by the total size of the images in bytes
+class ImageCache:
+    def __init__(self, budgetMB=512):
+        self.items = collections.OrderedDict()      # key -> (image, bytes), least recently used first
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.setBudget(budgetMB)
+    
+    def setBudget(self, budgetMB):
+        self.budget = int(budgetMB * 1024 * 1024)
+        self.evict()
+    
+    def __contains__(self, key):
+        return key in self.items
+    
+    # the image for 'key', None if not in the cache
+    def get(self, key):
+        item = self.items.pop(key, None)
+        if item is None:
+            self.misses += 1
+            return None
+        self.items[key] = item
+        self.hits += 1
+        return item[0]
+    
+    def put(self, key, image):
+        if key is None or image is None or image.isNull(): return
+        if key in self.items: self.nbytes -= self.items.pop(key)[1]
+        nbytes = image.byteCount()
+        if nbytes > self.budget: return
+        self.items[key] = (image, nbytes)
+        self.nbytes += nbytes
+        self.evict()
+    
+    # remove the least recently used images until the cache fits in the budget
+    def evict(self):
+        while self.nbytes > self.budget and self.items:
+            key, (image, nbytes) = self.items.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+    
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+    
+    def stats(self):
+        return '%d images, %.1f / %.1f MB, hits: %d, misses: %d, evictions: %d' % (len(self.items),
+                self.nbytes / 1048576.0, self.budget / 1048576.0, self.hits, self.misses, self.evictions)
+
+# Object regions (see Object.getObjectRegion) saved on the disk, one compressed file per image, so that
+# reopening an image reads its regions at once, without decoding and compositing the masks; a region is
+# saved as an 8-bit crop (index of its pixel colors, see regionColors) with its key in the store
+# (Store.cacheKey, changed when the mask is saved again). Only the last brush color of an image is kept
+# (the files of the other colors are removed); the files are written by 'writer' (AnnotationWriter)
+class RegionCache:
+    def __init__(self, cacheDir, writer=None):
+        self.cacheDir = cacheDir
+        self.writer = writer    # AnnotationWriter of the regions, None to write them at once
+        self.rgba = None        # brush color of the last regions loaded
+    
+    def path(self, fname, rgba):
+        return self.cacheDir + fname + '.%08x.npz' % rgba
+    # True if the regions of image 'fname' were saved, with the last brush color used
+    def has(self, fname):
+        return self.rgba is not None and os.path.exists(self.path(fname, self.rgba))
+    
+    # {repr(region key): region} of an image, {} if not saved
+    def load(self, fname, rgba):
+        self.rgba = rgba
+        colors = regionColors(rgba)
+        regions = {}
+        try:
+            data = numpy.load(self.path(fname, rgba))
+            keys = data['keys']
+            for i in range(len(keys)):
+                crop = data['r%d' % i]
+                region = QImage(crop.shape[1], crop.shape[0], QImage.Format_ARGB32_Premultiplied)
+                if region.width() > 0 and region.height() > 0: qimage2numpy(region, True)[:] = colors[crop]
+                regions[str(keys[i])] = region
+            data.close()
+        except (IOError, KeyError, ValueError, IndexError, zipfile.BadZipfile):
+            return {}
+        return regions
+    
+    # save the regions of image 'fname' in the background (at once without writer)
+    def put(self, fname, rgba, regions):
+        task = RegionTask(self, fname, rgba, regions)
+        if self.writer is None: self.write([task])
+        else: self.writer.write(task)
+    
+    # write the regions of the tasks (RegionTask); return the list of error messages
+    def write(self, tasks):
+        errors = []
+        for task in tasks:
+            if not self.save(task.fname, task.rgba, task.regions):
+                errors.append('Could not save the object regions of ' + task.fname)
+        return errors
+    
+    def save(self, fname, rgba, regions):
+        fpath = self.path(fname, rgba)
+        colors = regionColors(rgba)
+        arrays = {'keys': numpy.array(regions.keys(), dtype=str)}
+        for i, region in enumerate(regions.values()):
+            arr = qimage2numpy(region)
+            arrays['r%d' % i] = numpy.where(arr == colors[1], 1, numpy.where(arr == colors[0], 0, 2)).astype(numpy.uint8)
+        try:
+            cacheDir = os.path.dirname(fpath)
+            if not os.path.isdir(cacheDir): os.makedirs(cacheDir)
+            ofs = open(fpath + '.tmp', 'wb')
+            numpy.savez_compressed(ofs, **arrays)
+            ofs.close()
+            replaceFile(fpath + '.tmp', fpath)
+            # the regions of the other brush colors are outdated
+            base = os.path.basename(fname)
+            for name in os.listdir(cacheDir):
+                if len(name) == len(base) + 13 and name.startswith(base + '.') and name.endswith('.npz') \
+                        and cacheDir + '/' + name != fpath:
+                    os.remove(cacheDir + '/' + name)
+        except (IOError, OSError):
+            print 'Could not save the object regions to ', fpath
+            return False
+        return True
+
+# Object regions of an image to be written by AnnotationWriter in a RegionCache (the 'store' of the task)
+class RegionTask:
+    def __init__(self, cache, fname, rgba, regions):
+        self.store = cache
+        self.key = (cache, fname)
+        self.fname, self.rgba, self.regions = fname, rgba, regions
+    
+    # coalesce with a newer snapshot of the same image
+    def merge(self, task):
+        self.rgba, self.regions = task.rgba, task.regions
+
+# Limits the memory of the object masks and regions of the visited images (XImage): the pixel data of the
+# least recently viewed images is released when over the budget, except the masks not saved yet (saveMask
+# True, and their regions); it is loaded again (XImage.loadObjectImages) when the image is visited again
+class MaskMemory:
+    def __init__(self, budgetMB=256):
+        self.images = collections.OrderedDict()     # XImage -> bytes, least recently viewed first
+        self.nbytes = 0
+        self.evictions = 0
+        self.setBudget(budgetMB)
+    
+    def setBudget(self, budgetMB):
+        self.budget = int(budgetMB * 1024 * 1024)
+        self.evict()
+    
+    # the image is being viewed: (re)measure its pixel data, and release the others' if over the budget
+    def touch(self, ximg):
+        self.nbytes -= self.images.pop(ximg, 0)
+        nbytes = objectBytes(ximg)
+        self.images[ximg] = nbytes
+        self.nbytes += nbytes
+        self.evict()
+    
+    # release the saved masks and regions of the least recently viewed images (not of the current,
+    # i.e. last touched, one) until the total fits in the budget
+    def evict(self):
+        for ximg in self.images.keys()[:-1]:
+            if self.nbytes <= self.budget: break
+            self.nbytes -= self.images.pop(ximg)
+            for obj in ximg.objects:
+                if obj.mask and obj.saveMask: continue      # not saved yet
+                obj.deleteMask()
+                obj.region = None
+            nbytes = objectBytes(ximg)
+            if nbytes > 0: self.images[ximg] = nbytes      # unsaved data, kept as most recent
+            self.nbytes += nbytes
+            self.evictions += 1
+    
+    def clear(self):
+        self.images.clear()
+        self.nbytes = 0
+    
+    def stats(self):
+        return '%d images, %.1f / %.1f MB, evictions: %d' % (len(self.images),
+                self.nbytes / 1048576.0, self.budget / 1048576.0, self.evictions)
 
 # One image, containing the selected objects
-class XImage:
+class XImage(object):
+    __slots__ = ('label', 'fname', 'objects', 'indexByID', 'freeIDs', 'nextID', 'save',
+                 'size', 'imageStat', 'labelsStat', 'nobjects', 'labelsKnown')
+    
     def __init__(self, fname=None, label = LSKIP, set = S0, level = L0):
         self.label = label      # image label: positive/negative/skip
         
         self.fname = fname
         self.objects = []
+        self.indexByID = {}         # id -> index of the object in self.objects
+        self.freeIDs = []           # min-heap of the unused ids below nextID (may contain ids used since)
+        self.nextID = 0             # all the ids >= nextID are unused
         
         self.save = False
+        
+        # cached in the annotation manifest
+        self.size = None            # (width, height) of the image
+        self.imageStat = None       # [mtime, size] of the image file
+        self.labelsStat = None      # [mtime, size] of the .labels.txt file, None if there is no such file
+        self.nobjects = None        # number of objects, until the .labels.txt file is parsed
+        self.labelsKnown = False    # the objects or their number are known (parsed or from the manifest)
     
     def numObjects(self):
+        if self.nobjects is not None: return self.nobjects
         return len(self.objects)
     
     # check if this 'id' is used by any object
     def checkID(self, id):
-        for obj in self.objects:
-            if id == obj.id: return True
-        return False
-    # return an available id for a new object
+        return id in self.indexByID
+    # return the smallest available id for a new object
     def getID(self):
-        id = self.numObjects()
-        for i in range(id):
-            if self.checkID(i) == False:
-                return i            
-        return id
+        while self.freeIDs and self.freeIDs[0] in self.indexByID:
+            heapq.heappop(self.freeIDs)
+        if self.freeIDs: return self.freeIDs[0]
+        return self.nextID
+    
+    # add the object to the list, keeping the id lookup and the free ids in sync
+    def appendObject(self, obj):
+        self.indexByID[obj.id] = len(self.objects)
+        self.objects.append(obj)
+        if obj.id >= self.nextID:
+            for id in range(self.nextID, obj.id):
+                heapq.heappush(self.freeIDs, id)
+            self.nextID = obj.id + 1
     
     def mask(self, index):
-        if index < len(self.objects): return self.objects[index].mask
+        if index < len(self.objects): return self.objects[index].maskImage()
     
     def addObject (self, mask, region, x1, y1, id, w=0, h=0, text=None):
         obj = Object(mask, region, x1, y1, id, w, h, text)
-        self.objects.append(obj)
+        self.appendObject(obj)
         self.save = True    # image modified, need to save
     
+    # O(1): the last object of the list takes the place of the deleted one
     def deleteObject(self, id):
-        for obj in self.objects:
-            if id == obj.id:
-                self.objects.remove(obj)
-                self.save = True    # image modified, need to save
+        index = self.indexByID.pop(id, None)
+        if index is None: return
+        last = self.objects.pop()
+        if index < len(self.objects):
+            self.objects[index] = last
+            self.indexByID[last.id] = index
+        heapq.heappush(self.freeIDs, id)
+        self.save = True    # image modified, need to save
     
     def deleteObjectMasks(self):
         for obj in self.objects:
@@ -128,61 +1007,97 @@ class XImage:
     
     def deleteAllObjects(self):
         del self.objects[:]
+        self.indexByID.clear()
+        del self.freeIDs[:]
+        self.nextID = 0
         self.save = True    # image modified, need to save
         
     def getObjectText(self, id):
-        for obj in self.objects:
-            if obj.id == id:
-                return obj.text
+        if id in self.indexByID: return self.objects[self.indexByID[id]].text
         return "__none__"
     
     def setObjectText(self, id, text):
-        for obj in self.objects:
-            if obj.id == id:
-                obj.text = text
-                self.save = True    # image modified, need to save
-                break
-    
-    def saveObjectMasks(self, annotationDir):
-        for i in range(self.numObjects()):
-            imgName = os.path.splitext(self.fname)[0]
-            fname = annotationDir + imgName + '.' + str(self.objects[i].id) + '.png'
-            self.objects[i].save(fname)
-#        # delete unused masks from the disk
-#        i = self.numObjects()
-#        while True:
-#            imgName = os.path.splitext(self.fname)[0]            
-#            fname = annotationDir + imgName + '.' + str(i) + '.png'
-#            if not os.path.exists(fname): return
-#            else: os.remove(fname)
-            
-    def loadObjectMasks(self, annotationDir, forceLoad=False):
+        if id in self.indexByID:
+            self.objects[self.indexByID[id]].text = internLabel(text)
+            self.save = True    # image modified, need to save
+    
+    # mask file of the object
+    def maskPath(self, annotationDir, obj):
         imgName = os.path.splitext(self.fname)[0]
-        for i in range(self.numObjects()):
-            fname = annotationDir + imgName + '.' + str(self.objects[i].id) + '.png'
-            if os.path.exists(fname):
-                self.objects[i].loadObjectMask(fname, forceLoad)
+        return annotationDir + imgName + '.' + str(obj.id) + '.png'
+    
+    def loadObjectMasks(self, store, forceLoad=False):
+        files = store.savedMasks(self)
+        masks = readMasks(store, [files[store.maskKey(self, obj)] for obj in self.objects
+                                  if (forceLoad or not obj.mask) and store.maskKey(self, obj) in files])
+        for obj in self.objects:
+            fname = files.get(store.maskKey(self, obj))
+            if fname in masks:
+                obj.loadObjectMask(fname, forceLoad, masks[fname])
                 
-    def loadObjectImages(self, annotationDir, brushColor, forceLoad=False):        
-        if self.numObjects() == 0: return
+    # masks: {saved mask (see Store.savedMasks): mask image} of the already decoded (prefetched) masks
+    # cache: ImageCache of the object regions, for the masks saved in the store
+    # regionCache: RegionCache, the object regions of the image saved on the disk
+    def loadObjectImages(self, store, brushColor, forceLoad=False, masks=None, cache=None, regionCache=None):        
+        if len(self.objects) == 0: return
+        # going back to an image whose regions are all in memory costs nothing more (no listing, no reading)
+        if not forceLoad and all(obj.region is not None for obj in self.objects): return
         
-        imgName = os.path.splitext(self.fname)[0]
+        saved, regions, changed = {}, {}, False
+        if regionCache is not None: saved = regionCache.load(self.fname, brushColor.rgba())
+        files = store.savedMasks(self)
+        pending = []        # (object, saved mask, region cache key) of the regions to composite
         #delList = []
-        for i in range(self.numObjects()):
-            fname = annotationDir + imgName + '.' + str(self.objects[i].id) + '.png'
-            if os.path.exists(fname):
-                self.objects[i].loadObjectImage(fname, brushColor, forceLoad)
+        for i in range(len(self.objects)):
+            obj = self.objects[i]
+            fname = files.get(store.maskKey(self, obj))
+            key = None
+            if fname is not None and not (obj.mask and obj.saveMask):
+                key = store.cacheKey(fname, brushColor.rgba())
+            if obj.region and not forceLoad:
+                if key and obj.region: regions[repr(key)] = obj.region
+                continue
+            if key and cache is not None:
+                region = cache.get(key)
+                if region is not None:
+                    obj.region = regions[repr(key)] = region
+                    changed |= repr(key) not in saved
+                    continue
+            if key and repr(key) in saved:
+                obj.region = regions[repr(key)] = saved[repr(key)]
+                if cache is not None: cache.put(key, obj.region)
+                continue
+            pending.append((obj, fname, key))
+        
+        # the masks neither prefetched nor in memory are decoded in parallel, before any is composited
+        masks = dict(masks or {})
+        masks.update(readMasks(store, [fname for obj, fname, key in pending
+                                       if fname is not None and fname not in masks and not obj.mask]))
+        for obj, fname, key in pending:
+            if fname in masks: mask = masks[fname]
+            elif obj.mask: mask = None      # already in memory
+            else: continue
+            obj.loadObjectImage(fname, brushColor, forceLoad, mask)
+            if key and obj.region:
+                if cache is not None: cache.put(key, obj.region)
+                regions[repr(key)] = obj.region
+                changed = True
         #    else: delList.append(self.objects[i].id)                
         #for id in delList:
         #        self.deleteObject(id)
+        if regionCache is not None and (changed or len(regions) != len(saved)):
+            regionCache.put(self.fname, brushColor.rgba(), regions)
     
     def loadTxtFile(self, annotationDir):
-        if self.numObjects() > 0:
+        self.labelsKnown = True
+        if len(self.objects) > 0:
             print 'loadTxtFile: image.objects not empty -- no load.'
             return
         
+        self.nobjects = None
         filePath = annotationDir + self.fname + ".labels.txt"
-        if not os.path.exists(filePath): return        
+        self.labelsStat = fileStat(filePath)
+        if self.labelsStat is None: return        
         
         ifs = open(filePath, 'r')
         lines = ifs.readlines()
@@ -201,39 +1116,22 @@ class XImage:
             h = int(sline[4])
             text = ' '.join(sline[5:])
             #print 'Loaded:', text
-            utfstr = QString(unicode(text, 'utf8'))
-            obj = Object(None, None, x1, y1, id, w, h, utfstr)
-            self.objects.append(obj)
+            obj = Object(None, None, x1, y1, id, w, h, text)
+            self.appendObject(obj)
         
         ifs.close()
         print 'Loaded:', filePath
         
-    # save annotations for 'imagePath' to 'filePath'
-    def toTxtFile(self, annotationDir):
-        if self.numObjects()==0: return
-    
-        filePath = annotationDir + self.fname + ".labels.txt"
-        ofs = open(filePath, 'w')
-        if not ofs:
-            print 'Could not open file', filePath, 'to save image annotation!'
-            return
-        ofs.write(self.fname)        
-        for obj in self.objects:
-            ofs.write('\n')
-            ofs.write(str(obj.id) + ' ' )
-            ofs.write(str(obj.x1) + ' ' )
-            ofs.write(str(obj.y1) + ' ' )
-            ofs.write(str(obj.w) + ' ' )
-            ofs.write(str(obj.h) + ' ' )
-            ofs.write(obj.text.toUtf8())
-            #ofs.write(obj.text)
-        
-        ofs.close()
-        print 'Saved to:', filePath
+    # contents of the .labels.txt file
+    def labelsText(self):
+        return labelsText(self.fname, self.labelRows())
+    # (id, x1, y1, w, h, UTF-8 label) of the objects
+    def labelRows(self):
+        return [(obj.id, obj.x1, obj.y1, obj.w, obj.h, obj.text) for obj in self.objects]
     
     # save annotations, bounding boxes, like the output of a text detector (e.g., snoopertext) --> image.png.box.txt
     def toTxtBoxFile(self, imageDir, annotationDir):
-        if self.numObjects()==0: return
+        if len(self.objects)==0: return
     
         filePath = annotationDir + self.fname + ".box.txt"
         ofs = open(filePath, 'w')
@@ -242,8 +1140,8 @@ class XImage:
             return
         imagePath = imageDir + self.fname
         ofs.write(imagePath)
-        image = QPixmap(imagePath)
-        w,h = image.width(), image.height()        
+        if self.size is None: self.size = imageSize(imagePath)
+        w,h = self.size
         ofs.write('\n')
         ofs.write(str(w) + ' ' + str(h) )
         for obj in self.objects:
@@ -256,6 +1154,24 @@ class XImage:
         ofs.close()
         print 'Saved .box.txt to:', filePath
     
+    # info cached in the annotation manifest
+    def manifestEntry(self):
+        return {'name': self.fname, 'image': self.imageStat, 'size': self.size,
+                'labels': self.labelsStat, 'objects': self.numObjects()}
+    # restore the cached info of a manifest entry, if the annotations (e.g. .labels.txt file) did not change since
+    # (the image size is kept only if the image file did not change either)
+    # return False if the entry is out of date and the annotations must be loaded
+    def loadManifestEntry(self, entry, imageDir, store):
+        labelsStat = store.labelsStat(self.fname)
+        if labelsStat != entry['labels']: return False
+        self.labelsStat = labelsStat
+        self.nobjects = entry['objects']
+        self.labelsKnown = True
+        self.imageStat = fileStat(imageDir + self.fname)
+        if self.imageStat == entry['image'] and entry['size']:
+            self.size = tuple(entry['size'])
+        return True
+    
     def toString(self):
         pass
 #        lineStr = str(self.set) + ' ' + str(self.level) + ' ' + str(self.label) + ' ' + str(self.numObjects()) + ' ' + self.fname
@@ -263,16 +1179,147 @@ class XImage:
 #            lineStr += ' ' + str(obj.view) + ' ' + str(obj.label) + ' ' + str(obj.x1) + ' ' + str(obj.y1) + ' ' + str(obj.w) + ' ' + str(obj.h)
 #        return lineStr
         
+# Columnar index of all the object boxes of an annotation directory, saved as .npy files and memory mapped:
+# one row per box in the columns image, object, x1, y1, w, h, label; 'image' and 'label' index the image
+# name and label tables (UTF-8 strings concatenated in 'names'/'labels', with offset arrays). So a large
+# dataset is opened without parsing the annotations, and filtered with numpy expressions on the columns, e.g.
+#   index.find((index.w > 20) & (index.label == index.labelID('cat')))
+class BoxIndex:
+    COLUMNS = ('image', 'object', 'x1', 'y1', 'w', 'h', 'label')
+    VERSION = 1
+    
+    def __init__(self, indexDir):
+        self.indexDir = indexDir
+        self.load()
+    
+    def load(self):
+        self.count = 0
+        for name in self.COLUMNS: setattr(self, name, numpy.zeros(0, numpy.int32))
+        self.names, self.nameOffsets = numpy.zeros(0, numpy.uint8), numpy.zeros(1, numpy.int64)
+        self.labels, self.labelOffsets = numpy.zeros(0, numpy.uint8), numpy.zeros(1, numpy.int64)
+        self.stats = numpy.zeros((0, 2), numpy.float64)        # (mtime, size) of the annotations of each image
+        self.labelIDs = None        # label -> index in the label table, made at the first lookup
+        try:
+            ifs = open(self.indexDir + 'meta.json', 'r')
+            meta = json.load(ifs)
+            ifs.close()
+        except (IOError, ValueError):
+            return
+        if meta.get('version') != self.VERSION: return
+        for name in self.COLUMNS + ('names', 'nameOffsets', 'labels', 'labelOffsets', 'stats'):
+            setattr(self, name, loadColumn(self.indexDir + name + '.npy'))
+        self.count = meta['count']
+    
+    def __len__(self):
+        return self.count
+    def numImages(self):
+        return len(self.nameOffsets) - 1
+    def numLabels(self):
+        return len(self.labelOffsets) - 1
+    def imageName(self, i):
+        return self.names[self.nameOffsets[i]:self.nameOffsets[i+1]].tostring()
+    def labelText(self, i):
+        return self.labels[self.labelOffsets[i]:self.labelOffsets[i+1]].tostring()
+    # index of the (UTF-8) label in the label table, -1 if no box has that label
+    def labelID(self, label):
+        if self.labelIDs is None:
+            self.labelIDs = dict((self.labelText(i), i) for i in range(self.numLabels()))
+        return self.labelIDs.get(label, -1)
+    
+    # rows of the boxes matching the boolean expression 'where' (on the columns), and
+    # the label and the (minimum) width and height if given
+    def find(self, where=None, label=None, minWidth=None, minHeight=None):
+        match = numpy.ones(self.count, bool)
+        if where is not None: match &= where
+        if label is not None: match &= self.label == self.labelID(label)
+        if minWidth is not None: match &= self.w >= minWidth
+        if minHeight is not None: match &= self.h >= minHeight
+        return numpy.flatnonzero(match)
+    # (image name, object id, x1, y1, w, h, label) of the boxes at 'rows'
+    def boxes(self, rows):
+        return [(self.imageName(self.image[r]), int(self.object[r]), int(self.x1[r]), int(self.y1[r]),
+                 int(self.w[r]), int(self.h[r]), self.labelText(self.label[r])) for r in rows]
+    
+    # bring the index up to date with the annotations in 'store' (FileStore, SQLiteStore): only the images
+    # whose annotations changed since are loaded, the boxes of the others are copied from the index
+    # return the number of images loaded
+    def update(self, store):
+        names = store.imageNames()
+        stats = numpy.array([indexStat(store.labelsStat(f)) for f in names], numpy.float64).reshape(-1, 2)
+        old = dict((self.imageName(i), i) for i in range(self.numImages()))
+        labels = [self.labelText(i) for i in range(self.numLabels())]
+        labelIDs = dict(self.labelIDs or ((label, i) for i, label in enumerate(labels)))
+        
+        remap = numpy.zeros(self.numImages(), numpy.int32) - 1      # old image index -> new image index
+        rows, nloaded = [], 0
+        for j, f in enumerate(names):
+            i = old.get(f)
+            if i is not None and (self.stats[i] == stats[j]).all():
+                remap[i] = j
+                continue
+            ximg = XImage(f)
+            store.loadLabels(ximg)
+            for id, x1, y1, w, h, label in ximg.labelRows():
+                if label not in labelIDs:
+                    labelIDs[label] = len(labels)
+                    labels.append(label)
+                rows.append((j, id, x1, y1, w, h, labelIDs[label]))
+            nloaded += 1
+        # no image loaded, added or removed: the index is up to date, the columns are not written again
+        if nloaded == 0 and len(names) == self.numImages() and (remap == numpy.arange(len(names))).all(): return 0
+        
+        keep = numpy.flatnonzero(remap[self.image] >= 0) if self.count else numpy.zeros(0, numpy.int64)
+        rows = numpy.array(rows, numpy.int32).reshape(-1, len(self.COLUMNS))
+        columns = {}
+        for k, name in enumerate(self.COLUMNS):
+            column = getattr(self, name)[keep]
+            if name == 'image': column = remap[column]
+            columns[name] = numpy.concatenate((column, rows[:, k])).astype(numpy.int32)
+        order = numpy.argsort(columns['image'], kind='mergesort')       # the boxes of an image are together
+        for name in self.COLUMNS: columns[name] = columns[name][order]
+        columns['names'], columns['nameOffsets'] = packStrings(names)
+        columns['labels'], columns['labelOffsets'] = packStrings(labels)
+        columns['stats'] = stats
+        self.save(columns, len(order))
+        self.load()
+        return nloaded
+    
+    def save(self, columns, count):
+        if not os.path.isdir(self.indexDir): os.makedirs(self.indexDir)
+        # the old files may still be mapped: write new ones and rename them over the old
+        for name, column in columns.items():
+            fname = self.indexDir + name + '.npy'
+            ofs = open(fname + '.tmp', 'wb')
+            numpy.save(ofs, column)
+            ofs.close()
+        self.close()
+        for name in columns:
+            fname = self.indexDir + name + '.npy'
+            replaceFile(fname + '.tmp', fname)
+        writeFileAtomic(self.indexDir + 'meta.json', json.dumps({'version': self.VERSION, 'count': count}))
+    
+    # unmap the columns
+    def close(self):
+        for name in self.COLUMNS + ('names', 'nameOffsets', 'labels', 'labelOffsets', 'stats'):
+            setattr(self, name, None)
+        self.labelIDs = None
+        self.count = 0
+
 # all annotations, list of images + objects + object MBRs        
 class Annotation:
-    def __init__(self, fname=None):
+    def __init__(self, fname=None, writer=None):
         
         self.images = []
         self.index = 0      # index of the current image
         
         self.imageDir = None
+        self.complete = True        # False while the image list is being scanned (not to be saved in a manifest)
+        self.manifestEntries = {}   # image name -> manifest entry, of a manifest out of date (see loadAnnotation)
         self.dirPath = os.getcwd() + '/'
         self.annotationDir = self.dirPath + "ann/"
+        self.store = None           # annotation storage backend (FileStore or SQLiteStore) of annotationDir
+        self.regionCache = None     # RegionCache of annotationDir
+        self.writer = writer        # AnnotationWriter of the object regions, see RegionCache
         self.annfilename = fname
         if fname:
             self.loadAnnotation(fname)
@@ -326,6 +1373,7 @@ class Annotation:
             os.makedirs(dir)
             print dir, ' did not exist! Created..'
         self.annotationDir = dir + "/"
+        self.openStore()
         print 'Annotation directory changed to : ', self.annotationDir
         #return self.annotationDir
     
@@ -361,46 +1409,85 @@ class Annotation:
         self.deleteObjectsAt(self.index, ids)
     def deleteObjectsAt(self, index, ids):
         if index > self.numImages() or len(ids) == 0: return
-        self.images[index].loadObjectMasks(self.annotationDir)
+        self.images[index].loadObjectMasks(self.store)
         for id in ids:
             self.images[index].deleteObject(id)
         
     def loadDir(self, imageDir, fileExt):
+        if self.openDir(imageDir, fileExt) and self.complete: return
+        # list the images, keeping the ones of an out of date manifest
+        self.sortImages(self.listImages())
+        for ximg in self.images:
+            if ximg.labelsKnown: continue
+            ximg.imageStat = fileStat(self.imageDir + ximg.fname)
+            self.store.loadLabels(ximg)
+        print 'Number of images loaded: ', len(self.images)
+        #print 'loadDir:', self.annotationDir
+        self.saveAnnotationList()
+    
+    # set the image directory, and reopen it from its manifest if there is an up to date one
+    # return False if the images are still to be listed (by loadDir, or by a DirectoryScanner and addImages)
+    def openDir(self, imageDir, fileExt):
         print 'Image Directory: ', imageDir
         print 'File extension: ', fileExt
         self.imageDir = str(imageDir + '/')
         self.annotationDir = str(imageDir + '/ann/')
         
         self.fex = str(fileExt)
-        chain = self.imageDir + str(fileExt)
-        print chain
-        # get all the files with the given extension (full path)
-        imageFiles = glob.glob(chain)
-        imageList = []
-        # extract only the file names
-        for f in imageFiles:
-            imageList.append(os.path.basename(f))        
-        # sort the file names
-        imageList.sort(cmp=lambda x, y: cmp(x.lower(), y.lower()))        
-        # add to the list of images
-        for f in imageList:
-            ximg = XImage(f)
-            ximg.loadTxtFile(self.annotationDir)
-            self.images.append(ximg)
-        print 'Number of images loaded: ', len(self.images)
-        #print 'loadDir:', self.annotationDir
-        
-    # save the selected object masks of the current image as png images
-    # in the directory /path/to/data/annotation/
-    def saveCurrentObjectMasks(self, forceSave=False):
-        if self.images[self.index].save or forceSave:
-            self.saveObjectMasks(self.index)
+        self.openStore()
+        if self.loadAnnotation(self.manifestPath()): return True
+        self.complete = False
+        return False
     
-    def saveImageAnnAsTxt(self, forceSave=False):
-        if self.images[self.index].save or forceSave:
-            self.images[self.index].toTxtFile(self.annotationDir)
-        else:
-            print 'No change to save for image', self.index
+    # sorted list of the image file names in the image directory
+    def listImages(self):
+        print self.imageDir + self.fex
+        return sortImageNames(scanImages(self.imageDir, self.fex))
+    
+    # append the images 'names' found by a DirectoryScanner; their labels are read when visited or counted
+    def addImages(self, names):
+        for f in names:
+            self.images.append(XImage(f))
+    # reorder the images as 'names' (the sorted list of all the images), the current image is kept
+    def sortImages(self, names):
+        current = self.curImage()
+        images = dict((ximg.fname, ximg) for ximg in self.images)
+        self.images = [images.get(f) or XImage(f) for f in names]
+        if current in self.images: self.index = self.images.index(current)
+        else: self.index = max(0, min(self.index, len(self.images) - 1))      # removed from the directory
+        self.complete = True
+        self.manifestEntries = {}
+    # set the counts [(index, imageStat, labelsStat, nobjects)] of a DirectoryScanner,
+    # for the images whose .labels.txt file was not parsed meanwhile
+    def setCounts(self, counts):
+        for index, imageStat, labelsStat, nobjects in counts:
+            ximg = self.images[index]
+            if ximg.imageStat is None: ximg.imageStat = imageStat
+            if ximg.labelsKnown: continue
+            ximg.labelsStat, ximg.nobjects, ximg.labelsKnown = labelsStat, nobjects, True
+    
+    def manifestPath(self):
+        return self.annotationDir + MANIFEST_FILE
+    
+    # the box index of the annotation directory (BoxIndex), brought up to date with the store if 'update'
+    def boxIndex(self, update=True):
+        index = BoxIndex(self.annotationDir + BOX_INDEX_DIR)
+        if update:
+            n = index.update(self.store)
+            print 'Box index:', len(index), 'boxes in', index.numImages(), 'images,', n, 'images updated'
+        return index
+    
+    # open the storage backend of the annotation directory, see openStore
+    def openStore(self):
+        if self.store is None or self.store.annotationDir != self.annotationDir:
+            self.store = openStore(self.annotationDir)
+            self.regionCache = RegionCache(self.annotationDir + REGION_CACHE_DIR, self.writer)
+        
+    # save the current image annotations (labels + object masks) in the background with 'writer' (AnnotationWriter)
+    def saveCurrentAsync(self, writer, forceSave=False):
+        if self.numImages() == 0: return
+        if not (self.curImage().save or forceSave): return
+        writer.write(SaveTask(self.curImage(), self.store))
     
     def saveImageAnnAsBoxTxt(self, forceSave=False):
         if self.images[self.index].save or forceSave:
@@ -411,30 +1498,33 @@ class Annotation:
     # save all the annotations, to .box.txt files
     def saveALLImageAnnAsBoxTxt(self, forceSave=False):
         for i in range(self.numImages()):        
+            if self.images[i].labelsKnown and self.images[i].numObjects() == 0: continue
+            self.store.loadLabels(self.images[i])
             self.images[i].toTxtBoxFile(self.imageDir, self.annotationDir)        
     
     def toggleSave(self, flag=False):
         self.images[self.index].save = flag
     
     def loadImageAnnAsTxt(self):
-        self.images[self.index].loadTxtFile(self.annotationDir)
+        self.store.loadLabels(self.images[self.index])
     
-    def saveObjectMasks(self, index):
-        if self.numImages() == 0 or index >= self.numImages() : return
-        if self.image(index).numObjects() == 0: return
-        if not os.path.isdir(self.annotationDir):
-            print self.annotationDir, ' does not exist! create it..'
-            os.makedirs(self.annotationDir)        
-        self.image(index).saveObjectMasks(self.annotationDir)
-        print 'Saved object masks (selections)'
-        
     # load the already saved object masks from the disk
     def loadObjectMasks(self, index, forceLoad=False):
         if self.numImages() == 0 or index >= self.numImages() : return
-        self.images[index].loadObjectMasks(self.annotationDir, forceLoad)
-    def loadObjectImages(self, index, brushColor, forceLoad=False):
+        self.images[index].loadObjectMasks(self.store, forceLoad)
+    def loadObjectImages(self, index, brushColor, forceLoad=False, masks=None, cache=None):
         if self.numImages() == 0 or index >= self.numImages() : return
-        self.images[index].loadObjectImages(self.annotationDir, brushColor, forceLoad)
+        self.images[index].loadObjectImages(self.store, brushColor, forceLoad, masks, cache, self.regionCache)
+    
+    # image file and saved object masks (see Store.savedMasks) of image @index, to be decoded in advance
+    # by ImagePrefetcher; only the masks not already in memory are listed
+    def prefetchFiles(self, index):
+        ximg = self.image(index)
+        self.store.loadLabels(ximg)
+        if self.regionCache.has(ximg.fname): return self.imagePath(index), []    # the regions are read at once
+        files = self.store.savedMasks(ximg)
+        keys = [self.store.maskKey(ximg, obj) for obj in ximg.objects if not obj.mask]
+        return self.imagePath(index), [files[key] for key in keys if key in files]
     
     def getAnnotationListFile(self):
         return None
@@ -444,14 +1534,23 @@ class Annotation:
 #        filename += '.txt'
 #        return filename
         
+    # save the manifest of the image directory to the annotation directory
     def saveAnnotationList(self):        
-        pass
+        if self.imageDir is None or self.numImages() == 0 or not self.complete: return
+        if not os.path.isdir(self.annotationDir):
+            print self.annotationDir, ' does not exist! create it..'
+            os.makedirs(self.annotationDir)        
+        self.saveAnnotationListAs(self.manifestPath())
         #if self.annfilename is None:
         #self.annfilename = self.annotationDir + self.getAnnotationListFile()
         #self.saveAnnotationListAs(self.annfilename)        
     
     def saveAnnotationListAs(self, fname):
-        pass
+        manifest = {'version': MANIFEST_VERSION, 'imageDir': self.imageDir, 'fileExt': self.fex,
+                    'imageDirMtime': os.path.getmtime(self.imageDir), 'index': self.index,
+                    'images': [image.manifestEntry() for image in self.images]}
+        writeFileAtomic(fname, json.dumps(manifest))
+        print 'Annotation manifest saved to: ', fname
 #        if self.numImages() == 0: print 'Nothing to save yet!'; return    
 #        ofs = open(fname, 'w')
 #        if not ofs: print 'Could not open file to save!'; return    
@@ -469,8 +1568,48 @@ class Annotation:
 #        self.annfilename = fname
 #        print 'Annotation list saved to: ', fname
     
+    # load the image list from the manifest 'fname', saved by saveAnnotationList
+    # the directory is listed again only if its mtime changed, and only the .labels.txt files
+    # changed since the manifest was saved are parsed; return False if the manifest cannot be used
     def loadAnnotation(self, fname):
-        print 'TBI'
+        if not os.path.exists(fname): return False
+        try:
+            ifs = open(fname, 'r')
+            manifest = json.load(ifs)
+            ifs.close()
+        except (IOError, ValueError):
+            print 'Could not load annotation manifest ', fname
+            return False
+        if manifest.get('version') != MANIFEST_VERSION: return False
+        imageDir = manifest['imageDir'].encode('utf8')
+        fex = manifest['fileExt'].encode('utf8')
+        if self.imageDir is not None and (imageDir != self.imageDir or fex != self.fex): return False
+        if not os.path.isdir(imageDir): return False
+        self.imageDir, self.fex = imageDir, fex
+        self.annotationDir = os.path.dirname(os.path.abspath(fname)) + '/'
+        self.openStore()
+        
+        entries = {}
+        for entry in manifest['images']:
+            entries[entry['name'].encode('utf8')] = entry
+        imageList = [entry['name'].encode('utf8') for entry in manifest['images']]
+        # if images were added or removed since, the manifest list is shown meanwhile, and brought up to date
+        # by a DirectoryScanner seeded with the entries (the out of date ones are counted by the scanner)
+        self.complete = os.path.getmtime(self.imageDir) == manifest['imageDirMtime']
+        if not self.complete: self.manifestEntries = entries
+        nparsed = 0
+        for f in imageList:
+            ximg = XImage(f)
+            if not ximg.loadManifestEntry(entries[f], self.imageDir, self.store) and self.complete:
+                ximg.imageStat = fileStat(self.imageDir + f)
+                self.store.loadLabels(ximg)
+                nparsed += 1
+            self.images.append(ximg)
+        self.goto(manifest['index'])
+        print 'Loaded annotation manifest ', fname
+        print 'Number of images loaded: ', len(self.images), ', annotation files re-read: ', nparsed
+        if nparsed > 0: self.saveAnnotationList()
+        return True
 #        ifs = open(fname)
 #        if not ifs:
 #            print 'Could not load ', fname
@@ -499,7 +1638,7 @@ class Annotation:
         for i in range(int(tokens[1])):
             # Object(self, mask=None, region=None, x1=0, y1=0, id = 0, w = 0, h = 0, view = V0, label = LPOS )
             xobj = Object(None, None, int(tokens[4*i+3]), int(tokens[4*i+4]), i, int(tokens[4*i+5]), int(tokens[4*i+6]) )
-            ximg.objects.append(xobj)
+            ximg.appendObject(xobj)
         return ximg
     # updated version (22 October 2011)
     def parseLine(self, line):
@@ -510,7 +1649,7 @@ class Annotation:
         for i in range(int(tokens[3])):
             # Object(self, mask=None, region=None, x1=0, y1=0, id = 0, w = 0, h = 0, view = V0, label = LPOS )
             xobj = Object(None, None, int(tokens[6*i+7]), int(tokens[6*i+8]), i, int(tokens[6*i+9]), int(tokens[6*i+10]), int(tokens[6*i+5]), int(tokens[6*i+6]) )
-            ximg.objects.append(xobj)
+            ximg.appendObject(xobj)
         return ximg
         
         
@@ -524,8 +1663,237 @@ class Annotation:
 #            x1, y1, x2, y2 = c.min(), r.min(), c.max(), r.max() 
 #    return x1, y1, x2-x1+1, y2-y1+1
 
-# by Uwe Schmidt
-def getMBR_numpy(qimage):
+# replace 'fname' with the temporary file 'tmpname'
+def replaceFile(tmpname, fname):
+    if os.name == 'nt' and os.path.exists(fname): os.remove(fname)
+    os.rename(tmpname, fname)
+
+# write to a temporary file first, not to leave a truncated file behind
+def writeFileAtomic(fname, data):
+    tmpname = fname + '.tmp'
+    ofs = open(tmpname, 'w')
+    ofs.write(data)
+    ofs.close()
+    replaceFile(tmpname, fname)
+
+# ImageCache key of an image file: (path, mtime, size, extra), None if the file does not exist
+# (a file rewritten within one mtime tick, e.g. a mask saved again, is told apart by its size)
+def imageCacheKey(path, extra=None):
+    stat = fileStat(path)
+    if stat is None: return None
+    return (path, stat[0], stat[1], extra)
+
+# [mtime, size] of a file, None if it does not exist
+def fileStat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+# file names in 'imageDir' matching the pattern 'fileExt' (e.g. *.jpg), in directory order
+# (hidden files are skipped, as glob does)
+def scanImages(imageDir, fileExt):
+    if scandir is not None:
+        names = (entry.name for entry in scandir(imageDir) if entry.is_file())
+    else:
+        names = (f for f in os.listdir(imageDir) if os.path.isfile(os.path.join(imageDir, f)))
+    for f in names:
+        if not f.startswith('.') and fnmatch.fnmatch(f, fileExt): yield f
+
+# image file names sorted case insensitively
+def sortImageNames(names):
+    return sorted(names, key=lambda f: f.lower())
+
+# (labelsStat, number of objects) of a .labels.txt file, without parsing the objects
+def countLabels(filePath):
+    stat = fileStat(filePath)
+    if stat is None: return None, 0
+    try:
+        ifs = open(filePath, 'r')
+        lines = ifs.readlines()
+        ifs.close()
+    except IOError:
+        return None, 0
+    return stat, len([line for line in lines[1:] if line.strip()])
+
+# pixel value (premultiplied ARGB) of the brush color burned with a foreground mask pixel (QPainter's
+# ColorBurn of white over the brush color): the color itself for an opaque brush
+def burnColor(brushColor):
+    rgba, a = brushColor.rgba(), brushColor.alpha()
+    r, g, b = [min(255, c + 255 - a) for c in ((rgba >> 16) & 0xff, (rgba >> 8) & 0xff, rgba & 0xff)]
+    return 0xff000000 | (r << 16) | (g << 8) | b
+
+# pixel values of an object region (see Object.getObjectRegion) of the brush color 'rgba', indexed by the
+# 8-bit crops saved in RegionCache: the background, the foreground, and the fill beyond the mask
+def regionColors(rgba):
+    return numpy.array([0xff000000, burnColor(QColor.fromRgba(rgba)), rgba], dtype=numpy.uint32)
+
+# bytes of the pixel data (masks and regions) of the objects of an XImage
+def objectBytes(ximg):
+    nbytes = 0
+    for obj in ximg.objects:
+        if obj.mask: nbytes += obj.mask.counts.nbytes
+        if obj.region: nbytes += obj.region.byteCount()
+    return nbytes
+
+# shared copy of the (UTF-8) label string: the objects with the same label share one string
+LABELS = {}
+def internLabel(label):
+    if label is None: return None
+    return LABELS.setdefault(label, label)
+
+# contents of a .labels.txt file: the image name, then a line 'id x1 y1 w h label' per object
+def labelsText(fname, rows):
+    lines = [fname]
+    for row in rows:
+        lines.append(' '.join(str(x) for x in row))
+    return '\n'.join(lines)
+
+# storage backend of an annotation directory: 'backend' is 'files' or 'sqlite'; by default
+# SQLite if the directory contains an ANNOTATION_DB database, ANNOTATION_STORE otherwise
+def openStore(annotationDir, backend=None):
+    if backend is None:
+        if os.path.exists(annotationDir + ANNOTATION_DB): backend = 'sqlite'
+        else: backend = ANNOTATION_STORE
+    if backend == 'sqlite':
+        if not os.path.isdir(annotationDir): os.makedirs(annotationDir)
+        return SQLiteStore(annotationDir)
+    return FileStore(annotationDir)
+
+# copy all the annotations (labels and masks) of the store 'src' to 'dst', e.g. from a FileStore
+# to a SQLiteStore or back, writing 'batchSize' images at once; return (number of images, errors)
+def convertStore(src, dst, batchSize=100):
+    tasks, errors, n = [], [], 0
+    for name in src.imageNames():
+        ximg = XImage(name)
+        src.loadLabels(ximg)
+        files = src.savedMasks(ximg)
+        for obj in ximg.objects:
+            fname = files.get(src.maskKey(ximg, obj))
+            mask = None
+            if fname is not None: mask = src.readMask(fname)
+            if mask is not None:
+                obj.setMask(mask)
+                obj.saveMask = True     # to be written to dst
+        tasks.append(SaveTask(ximg, dst))
+        if len(tasks) == batchSize:
+            errors += dst.write(tasks)
+            n, tasks = n + len(tasks), []
+    if tasks: errors += dst.write(tasks)
+    return n + len(tasks), errors
+
+# save an RLEMask in MASK_CODEC format, see MASK_CODEC; return False on error
+def encodeMask(fname, mask, codec=None):
+    if codec is None: codec = MASK_CODEC
+    try:
+        if codec == 'png':
+            return mask.toQImage().save(fname, 'PNG', pngQuality(MASK_COMPRESSION))
+        ofs = open(fname, 'wb')
+        if codec == 'npy':
+            numpy.save(ofs, mask.toArray())
+        else:
+            ofs.write(struct.pack('<II', mask.w, mask.h))
+            ofs.write(numpy.packbits(mask.toArray() > 0).tostring())
+        ofs.close()
+    except IOError:
+        return False
+    return True
+
+# read a mask saved in any of the MASK_CODEC formats (by the file extension): a QImage for
+# PNG, an RLEMask for the others; None on error
+def decodeMask(fname):
+    try:
+        if fname.endswith(MASK_EXTENSIONS['npy']):
+            return RLEMask.fromArray(numpy.load(fname))
+        if fname.endswith(MASK_EXTENSIONS['bits']):
+            ifs = open(fname, 'rb')
+            data = ifs.read()
+            ifs.close()
+            w, h = struct.unpack('<II', data[:8])
+            bits = numpy.unpackbits(numpy.frombuffer(data[8:], numpy.uint8))[:w*h]
+            return RLEMask.fromArray(bits.reshape(h, w))
+    except (IOError, ValueError, struct.error):
+        return None
+    mask = QImage(fname)
+    if mask.isNull(): return None
+    return mask
+
+# QImage.save quality of a PNG for a zlib compression 'level' (0-9): Qt uses level = (100 - quality) * 9 / 91
+def pngQuality(level):
+    if level < 0: return -1
+    return 100 - (min(level, 9) * 91 + 8) // 9
+
+# .npy file memory mapped (read only), or read if it cannot be mapped (e.g. empty)
+def loadColumn(fname):
+    try:
+        return numpy.load(fname, mmap_mode='r')
+    except ValueError:
+        return numpy.load(fname)
+
+# strings concatenated in a uint8 array, and their offsets in it: string i is [offsets[i], offsets[i+1])
+def packStrings(strings):
+    offsets = numpy.zeros(len(strings) + 1, numpy.int64)
+    offsets[1:] = numpy.cumsum([len(x) for x in strings])
+    return numpy.array(bytearray(''.join(strings)), numpy.uint8), offsets
+
+# labelsStat of a store (file [mtime, size], or database revision) as a pair of numbers, for BoxIndex
+def indexStat(stat):
+    if stat is None: return (-1, -1)
+    if isinstance(stat, (list, tuple)): return tuple(stat)
+    return (stat, -1)
+
+# width and height of the image file, read from the file header without decoding the pixels
+def imageSize(imagePath):
+    size = QImageReader(imagePath).size()
+    if not size.isValid():      # the image format plugin cannot tell the size: decode the image
+        image = QImage(imagePath)
+        return image.width(), image.height()
+    return size.width(), size.height()
+
+# decode the image file reduced to fit in maxw x maxh (e.g., DCT scaling for JPEG), if it is larger
+# return (image, (w, h)) with the full size of the image if reduced, (image, None) if decoded at full size
+def decodeScaled(imagePath, maxw, maxh):
+    reader = QImageReader(imagePath)
+    size = reader.size()
+    if not size.isValid() or (size.width() <= maxw and size.height() <= maxh):
+        return reader.read(), None
+    reader.setScaledSize(size.scaled(maxw, maxh, Qt.KeepAspectRatio))
+    return reader.read(), (size.width(), size.height())
+
+# view the pixel buffer of an 8 or 32 bit qimage as a (h, w) numpy array, without copying
+# the array shares memory with qimage, so qimage must be kept alive while the array is used
+def qimage2numpy(qimage, writable=False):
+    h, w, bpl = qimage.height(), qimage.width(), qimage.bytesPerLine()
+    if writable: ptr = qimage.bits()
+    else: ptr = qimage.constBits()
+    ptr.setsize(qimage.byteCount())
+    if qimage.depth() == 8:
+        arr = numpy.frombuffer(ptr, numpy.uint8).reshape(h, bpl)
+    else:
+        arr = numpy.frombuffer(ptr, numpy.uint32).reshape(h, bpl/4)
+    return arr[:, :w]
+
+# boolean (h, w) array, True where any of the R, G, B components of a pixel is > 0
+def foregroundPixels(qimage):
+    if qimage.depth() == 8:
+        arr = qimage2numpy(qimage)
+        ctable = qimage.colorTable()
+        if len(ctable) == 0:        # no color table (e.g., Alpha8/Grayscale8): the value itself
+            return arr > 0
+        lut = numpy.zeros(256, numpy.bool_)
+        for i in range(len(ctable)):
+            lut[i] = (ctable[i] & 0x00ffffff) != 0
+        # alphaChannel() gives a gray ramp color table, index 0 is the only background value
+        if not lut[0] and lut[1:len(ctable)].all():
+            return arr > 0
+        return lut[arr]
+    if qimage.depth() != 32:
+        qimage = qimage.convertToFormat(QImage.Format_ARGB32)
+    return (qimage2numpy(qimage) & 0x00ffffff) != 0
+
+# by Uwe Schmidt -- per pixel version, kept as reference for getMBR_numpy
+def getMBR_pixel(qimage):
     x1, y1, x2, y2 = -1, -1, -1, -1
     if qimage:
         fg, x1, y1, x2, y2 = 0, float('inf'), float('inf'), float('-inf'), float('-inf')
@@ -536,9 +1904,20 @@ def getMBR_numpy(qimage):
               fg = 1; y1 = min(y,y1); x1 = min(x,x1); y2 = max(y,y2); x2 = max(x,x2)
         if fg == 0:
           x1, y1, x2, y2 = -1, -1, -1, -1
-        # qimage.save("tmp.png")
-        # nimg = scipy.misc.imread('tmp.png')
-        # r,c = numpy.where(nimg > 0)
-        # if len(r) > 0:      # check if there is any FG pixel
-        #     x1, y1, x2, y2 = c.min(), r.min(), c.max(), r.max() 
-    return x1, y1, x2-x1+1, y2-y1+1
\ No newline at end of file
+    return x1, y1, x2-x1+1, y2-y1+1
+
+# minimum bounding rectangle (x1, y1, w, h) of the foreground pixels of qimage
+# same output as getMBR_pixel: x1 = y1 = -1 (w = h = 1) if there is no foreground pixel
+def getMBR_numpy(qimage):
+    if qimage and not qimage.isNull():
+        return getMBR_array(foregroundPixels(qimage))
+    return -1, -1, 1, 1
+
+# minimum bounding rectangle (x1, y1, w, h) of the nonzero pixels of a (h, w) array, as getMBR_numpy
+def getMBR_array(fg):
+    x1, y1, x2, y2 = -1, -1, -1, -1
+    rows = numpy.flatnonzero(fg.any(axis=1))
+    if len(rows) > 0:      # check if there is any FG pixel
+        cols = numpy.flatnonzero(fg[rows[0]:rows[-1]+1].any(axis=0))
+        x1, y1, x2, y2 = int(cols[0]), int(rows[0]), int(cols[-1]), int(rows[-1])
+    return x1, y1, x2-x1+1, y2-y1+1
@@ -3,7 +3,10 @@
 
 import sys
 import os
+import math
 import functools
+import collections
+import numpy
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 from Ann import *
@@ -27,9 +30,205 @@ DRAWPOLY = 4    # paint filled rounded rectangle
 BRUSH_TYPES_STR = ["Line", "Circle", "Rectangle", "Rounded rect.", "Polygon"]
 BRUSH_TYPES_INT = [DRAWL, DRAWELL, DRAWRECT, DRAWRECTR, DRAWPOLY]
 
+# number of images decoded in advance, before and after the current image
+PREFETCH_DEPTH = 2
+# memory budget (MB) for the decoded images and object regions kept in memory
+IMAGE_CACHE_MB = 512
+# memory budget (MB) of the object masks and regions of the visited images, see MaskMemory
+MASK_MEMORY_MB = 256
+# decode the images not prefetched/cached at the view size first, full resolution when zoomed in
+REDUCED_DECODE = True
+# background images are drawn in tiles of TILE_SIZE x TILE_SIZE pixels, from a pyramid of at most MIPMAP_LEVELS levels
+TILE_SIZE = 512
+MIPMAP_LEVELS = 6
+# memory budget (MB) of the background tiles (QPixmap) of the shown image, least recently drawn first released
+TILE_CACHE_MB = 128
+# the painting (selection) is stored in tiles of CANVAS_TILE_SIZE x CANVAS_TILE_SIZE pixels, only where painted
+CANVAS_TILE_SIZE = 256
+
 
 ###  FUNCTIONS AND CLASSES ###
 
+# Background image of a scene, drawn tile by tile: only the tiles in the exposed rectangle are drawn,
+# from the (half resolution) mipmap level closest to the current view scale
+# levels (QImage) and tiles (QPixmap) are created when first drawn; the image is never made into one QPixmap
+# (too large for a gigapixel image), and the tiles are kept in a least recently used cache of budgetMB
+# one TiledImage is shared by the scenes showing the same image
+class TiledImage:
+    def __init__(self, image, w, h, tileSize=TILE_SIZE, budgetMB=TILE_CACHE_MB):
+        self.levels = [image]       # mipmap pyramid, level 0 is the image itself
+        self.w, self.h = w, h       # size of the image in scene coordinates (larger if image is reduced)
+        self.tileSize = tileSize
+        self.tiles = collections.OrderedDict()     # (level, column, row) -> QPixmap, least recently drawn first
+        self.nbytes = 0
+        self.budget = int(budgetMB * 1024 * 1024)
+    
+    def width(self):
+        return self.levels[0].width()
+    def height(self):
+        return self.levels[0].height()
+    
+    def level(self, k):
+        while len(self.levels) <= k:
+            prev = self.levels[-1]
+            self.levels.append(prev.scaled(max(1, prev.width()/2), max(1, prev.height()/2), Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+        return self.levels[k]
+    
+    def tile(self, k, col, row):
+        key = (k, col, row)
+        tile = self.tiles.pop(key, None)
+        if tile is None:
+            ts = self.tileSize
+            level = self.level(k)
+            tile = QPixmap.fromImage(level.copy(QRect(col*ts, row*ts, ts, ts).intersected(level.rect())))
+            self.nbytes += tile.width() * tile.height() * tile.depth() / 8
+        self.tiles[key] = tile
+        return tile
+    # release the least recently drawn tiles until the tiles fit in the budget
+    def evict(self):
+        while self.nbytes > self.budget and len(self.tiles) > 1:
+            key, tile = self.tiles.popitem(last=False)
+            self.nbytes -= tile.width() * tile.height() * tile.depth() / 8
+    
+    # draw the part of the image in 'rect' (scene coordinates)
+    def draw(self, painter, rect):
+        # screen pixels per image pixel
+        scale = painter.worldTransform().m11() * self.w / self.width()
+        k = 0
+        while scale <= 0.5 and k+1 < MIPMAP_LEVELS and self.level(k).width() > self.tileSize:
+            scale *= 2
+            k += 1
+        image = self.level(k)
+        fx, fy = image.width() / float(self.w), image.height() / float(self.h)
+        ts = self.tileSize
+        rect = rect.intersected(QRectF(0, 0, self.w, self.h))
+        if rect.isEmpty(): return
+        c0, c1 = int(rect.left()*fx) / ts, min(int(rect.right()*fx) / ts, (image.width()-1) / ts)
+        r0, r1 = int(rect.top()*fy) / ts, min(int(rect.bottom()*fy) / ts, (image.height()-1) / ts)
+        for row in range(r0, r1+1):
+            for col in range(c0, c1+1):
+                tile = self.tile(k, col, row)
+                target = QRectF(col*ts/fx, row*ts/fy, tile.width()/fx, tile.height()/fy)
+                painter.drawPixmap(target, tile, QRectF(tile.rect()))
+        self.evict()        # after drawing, not to release a tile of this frame
+
+# Painting canvas of w x h pixels, made of tiles allocated only where painted
+# each tile is an 8 bit image holding the alpha of the painting; it is colored only when drawn, with a color table
+class SparseCanvas:
+    def __init__(self, w, h, color=BRUSH_COLOR, tileSize=CANVAS_TILE_SIZE):
+        self.w, self.h = w, h
+        self.tileSize = tileSize
+        self.tiles = {}             # (column, row) -> QImage (Format_Indexed8)
+        self.pen, self.brush, self.erasing = QPen(Qt.NoPen), QBrush(Qt.NoBrush), False
+        self.setColor(color)
+    
+    # color of the painting, when drawn
+    def setColor(self, color):
+        self.colorTable = [qRgba(color.red(), color.green(), color.blue(), i) for i in range(256)]
+        for tile in self.tiles.values():
+            tile.setColorTable(self.colorTable)
+    
+    def rect(self):
+        return QRect(0, 0, self.w, self.h)
+    def tileRect(self, key):
+        ts = self.tileSize
+        return QRect(key[0]*ts, key[1]*ts, ts, ts)
+    # keys of the (allocated or not) tiles intersecting rect
+    def tileKeys(self, rect):
+        rect = QRectF(rect).toAlignedRect().intersected(self.rect())
+        if rect.isEmpty(): return []
+        ts = self.tileSize
+        return [(c, r) for r in range(rect.top() / ts, rect.bottom() / ts + 1)
+                       for c in range(rect.left() / ts, rect.right() / ts + 1)]
+    def tile(self, key):
+        if key not in self.tiles:
+            tile = QImage(self.tileSize, self.tileSize, QImage.Format_Indexed8)
+            tile.setColorTable(self.colorTable)
+            tile.fill(0)
+            self.tiles[key] = tile
+        return self.tiles[key]
+    # (rows, columns) slices of the part of rect in the tile, in tile coordinates
+    def tileSlices(self, key, rect):
+        r = self.tileRect(key).intersected(rect).translated(-self.tileRect(key).topLeft())
+        return slice(r.top(), r.bottom()+1), slice(r.left(), r.right()+1)
+    
+    # drop all the painting
+    def clear(self):
+        self.tiles.clear()
+    
+    # pen and brush to paint with, or to erase with if 'erasing'
+    def setTool(self, pen, brush, erasing=False):
+        self.pen, self.brush, self.erasing = QPen(pen), QBrush(brush), erasing
+        if erasing:     # erase wherever covered, whatever the (transparent) erasing color is
+            if self.pen.style() != Qt.NoPen: self.pen.setColor(Qt.white)
+            if self.brush.style() != Qt.NoBrush: self.brush.setColor(Qt.white)
+    # paint the path, covering the (scene) rectangle rect: the path is rasterized once in
+    # a temporary image of the size of rect, and its alpha is blended into the touched tiles
+    def drawPath(self, path, rect):
+        rect = QRectF(rect).toAlignedRect().intersected(self.rect())
+        if rect.isEmpty(): return
+        stamp = QImage(rect.size(), QImage.Format_ARGB32)
+        stamp.fill(QColor(0, 0, 0, 0).rgba())
+        painter = QPainter(stamp)
+        painter.translate(-rect.topLeft())
+        painter.setPen(self.pen)
+        painter.setBrush(self.brush)
+        painter.drawPath(path)
+        painter.end()
+        cover = (qimage2numpy(stamp) >> 24).astype(numpy.uint16)
+        for key in self.tileKeys(rect):
+            # nothing to erase on an empty tile
+            if self.erasing and key not in self.tiles: continue
+            rows, cols = self.tileSlices(key, rect)
+            r = self.tileRect(key).intersected(rect).translated(-rect.topLeft())
+            c = cover[r.top():r.bottom()+1, r.left():r.right()+1]
+            t = qimage2numpy(self.tile(key), True)[rows, cols]
+            if self.erasing: t[:] = t * (255 - c) // 255
+            else: t[:] = t + c * (255 - t) // 255      # source over
+    
+    # draw the part of the canvas in rect
+    def draw(self, painter, rect):
+        for key in self.tileKeys(rect):
+            if key not in self.tiles: continue
+            r = QRectF(self.tileRect(key)).intersected(rect)
+            painter.drawImage(r, self.tiles[key], r.translated(-QPointF(self.tileRect(key).topLeft())))
+    
+    # the part of the canvas in rect, as a colored (ARGB) image
+    def copy(self, rect):
+        image = QImage(rect.size(), QImage.Format_ARGB32)
+        image.fill(QColor(0, 0, 0, 0).rgba())
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        for key in self.tileKeys(rect):
+            if key not in self.tiles: continue
+            r = self.tileRect(key).intersected(rect)
+            painter.drawImage(r.translated(-rect.topLeft()), self.tiles[key], r.translated(-self.tileRect(key).topLeft()))
+        painter.end()
+        return image
+    
+    # alpha of the part of the canvas in rect, as a (h, w) uint8 array
+    def alpha(self, rect):
+        arr = numpy.zeros((rect.height(), rect.width()), numpy.uint8)
+        for key in self.tileKeys(rect):
+            if key not in self.tiles: continue
+            rows, cols = self.tileSlices(key, rect)
+            r = self.tileRect(key).intersected(rect).translated(-rect.topLeft())
+            arr[r.top():r.bottom()+1, r.left():r.right()+1] = qimage2numpy(self.tiles[key])[rows, cols]
+        return arr
+    
+    # MBR (x1, y1, w, h) of the painted pixels in rect, only the allocated tiles are scanned; x1 = -1 if none
+    def mbr(self, rect):
+        mbr = QRect()
+        for key in self.tileKeys(rect):
+            if key not in self.tiles: continue
+            rows, cols = self.tileSlices(key, rect)
+            x1,y1,w,h = getMBR_array(qimage2numpy(self.tiles[key])[rows, cols])
+            if x1 < 0: continue
+            r = self.tileRect(key).intersected(rect)
+            mbr = mbr.united(QRect(x1 + r.x(), y1 + r.y(), w, h))
+        if mbr.isEmpty(): return -1, -1, 1, 1
+        return mbr.x(), mbr.y(), mbr.width(), mbr.height()
+
 # ObjectItem corresponds to Object in Ann.py
 class ObjectItem(QGraphicsItem):
     def __init__(self, qimage, x, y, scene, id, opacity, drawMBR):
@@ -94,6 +293,7 @@ class ImageDrawScene(QGraphicsScene):
         super(ImageDrawScene, self).__init__()
         self.main = main
         self.backgroundImage = None
+        self.backgroundTiles = None
         self.foregroundImage = None
         self.setSceneRect(0, 0, WMIN, HMIN)        
         self.w, self.h = 1,1
@@ -113,6 +313,14 @@ class ImageDrawScene(QGraphicsScene):
         self.pen.setColor(self.dcolor)
         self.pen.setWidth(2*self.dradius)
         self.pen.setCapStyle(Qt.RoundCap)
+        self.pen.setJoinStyle(Qt.RoundJoin)
+        
+        # stroke being painted: points collected from the mouse events, painted once per frame (timer)
+        self.stroking = False
+        self.strokePoints = []
+        self.strokeTimer = QTimer(self)
+        self.strokeTimer.setInterval(16)
+        self.connect(self.strokeTimer, SIGNAL('timeout()'), self.flushStroke)
         
         self.polypen = QPen(Qt.SolidLine)
         self.polypen.setColor(self.dcolor)
@@ -124,10 +332,22 @@ class ImageDrawScene(QGraphicsScene):
         self.polyLast = None        
         self.setBrushType(BRUSH_TYPES_INT[0])
         
+        # union of the rectangles painted on foregroundImage since the last reset
+        self.dirtyRect = QRect()
+        # last updated rectangle of the polygon being drawn
+        self.polyRect = QRectF()
+        
+        # frames per second counter, shown in the status bar
+        self.showFPS = False
+        self.frames = 0
+        self.fpsTime = QTime()
+        self.fpsTime.start()
+        
     def setRadius(self, radius):
+        rect = self.cursorRect(self.mpos)
         self.dradius = radius
         self.pen.setWidth(2*self.dradius)
-        self.update()
+        self.update(rect.united(self.cursorRect(self.mpos)))
     
     def setBrushType(self, dtype):
         if dtype in BRUSH_TYPES_INT:
@@ -141,22 +361,30 @@ class ImageDrawScene(QGraphicsScene):
         self.dbrush.setColor(self.dcolor)
         self.pen.setColor(self.dcolor)
         self.polypen.setColor(self.dcolor)
+        if self.foregroundImage: self.foregroundImage.setColor(self.dcolor)
         self.update()
     
-    def setImage(self, image):
+    # fullSize: (w, h) of the image, if 'image' is a reduced resolution version of it
+    # the scene (and the painting) is always in full resolution image coordinates
+    # tiles: the TiledImage of 'image', if already made for another scene
+    def setImage(self, image, fullSize=None, tiles=None):
         if image:            
-            self.w, self.h = image.width(), image.height()
-            self.setBackground(image)
+            self.w, self.h = fullSize or (image.width(), image.height())
+            self.setBackground(image, tiles)
             self.setForeground(self.w, self.h)
             self.setSceneRect(0, 0, self.w, self.h)            
         else:
             self.setSceneRect(0, 0, WMIN, HMIN)
         self.update()
     
+    # the painting canvas allocates memory only where painted, so (re)setting it costs nothing
     def setForeground(self, w, h):        
-        #self.foregroundImage = QImage(w, h, QImage.Format_ARGB32_Premultiplied)
-        self.foregroundImage = QImage(w, h, QImage.Format_ARGB32)
-        self.foregroundImage.fill(QColor(0, 0, 0, 0).rgba())        
+        self.endStroke()
+        if self.foregroundImage and (self.foregroundImage.w, self.foregroundImage.h) == (w, h):
+            self.foregroundImage.clear()
+        else:
+            self.foregroundImage = SparseCanvas(w, h, self.dcolor)
+        self.dirtyRect = QRect()
     # reset painting
     def resetForeground(self):
         if self.w > 1 and self.h > 1:
@@ -169,15 +397,31 @@ class ImageDrawScene(QGraphicsScene):
         if self.dtype == DRAWPOLY:
             self.startPolygon()            
         self.update()
-    # return the selected object as a single channel image
-    def getObjectMask(self):
+    # return the selected object as a mask (RLEMask), cropped to rect if given
+    def getObjectMask(self, rect=None):
         if self.foregroundImage:
-            return self.foregroundImage.alphaChannel()
+            if rect is None: rect = self.foregroundImage.rect()
+            return RLEMask.fromArray(self.foregroundImage.alpha(rect))
+        else: return None
+    # return the selected object (painting) in rect
+    def getObjectImage(self, rect):
+        if self.foregroundImage: return self.foregroundImage.copy(rect)
         else: return None
+    # MBR (x1, y1, w, h) of the selected object, x1 = -1 if nothing is selected
+    # only the painted (dirty) region of the foreground is scanned, not the whole image
+    def getObjectMBR(self):
+        if not self.foregroundImage or self.dirtyRect.isEmpty(): return -1, -1, 1, 1
+        return self.foregroundImage.mbr(self.dirtyRect)
+    # add the (scene) rectangle touched by a stroke to the dirty region
+    # erasing only removes pixels, so the dirty region stays a valid upper bound of the object
+    def markDirty(self, rect):
+        rect = rect.toAlignedRect().adjusted(-1, -1, 1, 1).intersected(self.foregroundImage.rect())
+        self.dirtyRect = self.dirtyRect.united(rect)
     
-    def setBackground(self, image):
+    def setBackground(self, image, tiles=None):
         if image:
-            self.backgroundImage = image.copy()            
+            self.backgroundImage = image
+            self.backgroundTiles = tiles or TiledImage(image, self.w, self.h)
             self.update()
     
     # overridden
@@ -186,8 +430,32 @@ class ImageDrawScene(QGraphicsScene):
             self.drawPolygon(painter)
         if self.foregroundImage:
             painter.setOpacity(self.opacity)
-            painter.drawImage(0, 0, self.foregroundImage)
+            self.foregroundImage.draw(painter, rect)
         if self.showBrush: self.drawCursor(painter)
+        if self.showFPS: self.countFrame()
+    
+    def countFrame(self):
+        self.frames += 1
+        ms = self.fpsTime.elapsed()
+        if ms >= 1000:
+            self.main.statusMessage('Painting area: %.1f frames per second' % (1000.0 * self.frames / ms))
+            self.frames = 0
+            self.fpsTime.restart()
+    
+    # scene rectangle covered by the brush cursor at pos
+    def cursorRect(self, pos):
+        r = self.dradius + 2
+        return QRectF(pos.x()-r, pos.y()-r, 2*r, 2*r)
+    # scene rectangle covered by the polygon being drawn, including the rubber band to the mouse position
+    def polygonRect(self):
+        polygon = QPolygonF(self.polygon)
+        if self.polyLast: polygon.append(self.polyLast)
+        return polygon.boundingRect().adjusted(-6, -6, 6, 6)
+    # update the polygon area, both the previous and the current one
+    def updatePolygon(self):
+        rect = self.polygonRect()
+        self.update(rect.united(self.polyRect))
+        self.polyRect = rect
     
     def drawPolygon(self, painter):
         n = self.polygon.size()        
@@ -204,10 +472,14 @@ class ImageDrawScene(QGraphicsScene):
         if self.polyLast:
             self.polygon.remove(n-1)
             self.polyLast = None
+    # scale from the background image to the scene, > 1 if the background has reduced resolution
+    def backgroundScale(self):
+        if not self.backgroundImage: return 1.0
+        return float(self.w) / self.backgroundImage.width()
     # overridden
     def drawBackground (self, painter, rect):
-        if self.backgroundImage:
-            painter.drawPixmap(0, 0, self.backgroundImage)
+        if self.backgroundTiles:
+            self.backgroundTiles.draw(painter, rect)
     
     def contextMenuEvent(self, event):        
         cmenu = QMenu()
@@ -227,11 +499,18 @@ class ImageDrawScene(QGraphicsScene):
             else: cmenu.addAction("Show brush", self.toggleBrushFlag)        
         cmenu.addAction("Increase opacity", self.increaseOpacity)            
         cmenu.addAction("Decrease opacity", self.decreaseOpacity)            
+        cmenu.addSeparator()
+        if self.showFPS: cmenu.addAction("Hide frames per second", self.toggleFPS)
+        else: cmenu.addAction("Show frames per second", self.toggleFPS)
         cmenu.exec_(event.screenPos())
         super(ImageDrawScene, self).contextMenuEvent(event)
     def toggleBrushFlag(self):
         self.showBrush = not self.showBrush
         self.update()
+    def toggleFPS(self):
+        self.showFPS = not self.showFPS
+        self.frames = 0
+        self.fpsTime.restart()
     def togglePaintErase(self):
         self.erasing = not self.erasing
         if self.erasing:
@@ -259,64 +538,106 @@ class ImageDrawScene(QGraphicsScene):
         elif self.opacity < 0.1: self.opacity = 0.1
         self.update()
     
+    # only the brush cursor (old and new position) and the painted stroke are updated, not the whole scene
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
             if self.dtype == DRAWPOLY and self.polyDrawing:
                 self.polygon.append(event.scenePos())
                 self.polyLast = None
+                self.updatePolygon()
             else:
-                self.painting = True
-                self.drawOnImage(event, self.dtype)                       
-            self.update()
+                self.painting = self.beginStroke()
+                if self.painting:
+                    self.strokePoints.append(event.scenePos())
+                    self.flushStroke()
+                self.update(self.cursorRect(self.mpos))
         
     def mouseReleaseEvent(self, event):
         if self.dtype == DRAWPOLY: return
         if event.button() == Qt.LeftButton:
             self.painting = False
-            self.x0, self.y0 = -1,-1
-            self.update()
+            self.endStroke()
+            self.update(self.cursorRect(self.mpos))
         
+    # the stroke points are collected here and painted by flushStroke, once per frame
     def mouseMoveEvent (self, event):
         if self.dtype == DRAWPOLY:
             if self.polyDrawing:
                 self.polyLast = event.scenePos()
-                self.update()
+                self.updatePolygon()
             return
+        rect = self.cursorRect(self.mpos)
         self.mpos = event.scenePos()
+        rect = rect.united(self.cursorRect(self.mpos))
         if self.painting:
-            self.drawOnImage(event, self.dtype)
-        self.update()  
-        
-    def drawOnImage(self, event, dtype = DRAWELL):
-        if not (self.foregroundImage and self.backgroundImage): return
-        pos = event.scenePos()
-        x, y = pos.x(), pos.y()            
-        painter = QPainter(self.foregroundImage)
-        if self.erasing: 
-            painter.setCompositionMode(QPainter.CompositionMode_Clear)
-        if dtype == DRAWL: painter.setPen(self.pen)
-        else:
-            painter.setPen(Qt.NoPen)        
-            painter.setBrush(self.dbrush)            
-        if dtype == DRAWELL:
-            painter.drawEllipse(pos, self.dradius, self.dradius)       
-        elif dtype == DRAWRECT:            
-            painter.drawRect(x-self.dradius, y-self.dradius, 2*self.dradius, 2*self.dradius)
-        elif dtype == DRAWRECTR:
-            painter.drawRoundedRect(x-self.dradius, y-self.dradius, 2*self.dradius, 2*self.dradius, 25.0, 25.0, mode=Qt.RelativeSize)
-        elif dtype == DRAWL and self.x0 >= 0 and self.y0 >= 0:            
-            painter.drawLine(self.x0, self.y0, x, y)
-        self.x0, self.y0 = x, y
-            
-        painter.end()
+            self.strokePoints.append(self.mpos)
+        self.update(rect)  
+    
+    # start a stroke: the pen/brush is set on the foreground until endStroke; the stroke points are
+    # painted in batches (flushStroke), each path rasterized once in a stamp and blended into the tiles
+    def beginStroke(self):
+        if not (self.foregroundImage and self.backgroundImage): return False
+        self.endStroke()
+        if self.dtype == DRAWL: self.foregroundImage.setTool(self.pen, QBrush(Qt.NoBrush), self.erasing)
+        else: self.foregroundImage.setTool(QPen(Qt.NoPen), self.dbrush, self.erasing)
+        self.stroking = True
+        self.strokePoints = []
+        self.x0, self.y0 = -1, -1
+        self.strokeTimer.start()
+        return True
+    def endStroke(self):
+        if not self.stroking: return
+        self.flushStroke()
+        self.strokeTimer.stop()
+        self.stroking = False
+        self.x0, self.y0 = -1, -1
+    
+    # paint the stroke points collected since the last frame, as one path
+    # circles/rectangles are stamped at most r/2 apart, so that fast strokes leave no gaps
+    def flushStroke(self):
+        if not self.stroking or len(self.strokePoints) == 0: return
+        path = QPainterPath()
+        path.setFillRule(Qt.WindingFill)
+        r = self.dradius
+        step = max(1.0, r / 2.0)
+        for pos in self.strokePoints:
+            x, y = pos.x(), pos.y()
+            if self.dtype == DRAWL:
+                if self.x0 >= 0 and self.y0 >= 0:
+                    if path.elementCount() == 0: path.moveTo(self.x0, self.y0)
+                    path.lineTo(x, y)
+            elif self.x0 < 0 or self.y0 < 0:
+                self.addStamp(path, x, y)
+            else:
+                n = max(1, int(math.ceil(math.hypot(x - self.x0, y - self.y0) / step)))
+                for i in range(1, n+1):
+                    self.addStamp(path, self.x0 + (x - self.x0)*i/n, self.y0 + (y - self.y0)*i/n)
+            self.x0, self.y0 = x, y
+        self.strokePoints = []
+        if path.elementCount() == 0: return
+        rect = path.boundingRect()
+        if self.dtype == DRAWL: rect = rect.adjusted(-r, -r, r, r)
+        self.foregroundImage.drawPath(path, rect.adjusted(-1, -1, 1, 1))
+        if not self.erasing: self.markDirty(rect)
+        self.update(rect.adjusted(-1, -1, 1, 1))
+    
+    def addStamp(self, path, x, y):
+        r = self.dradius
+        if self.dtype == DRAWELL:
+            path.addEllipse(QPointF(x, y), r, r)
+        elif self.dtype == DRAWRECT:            
+            path.addRect(x-r, y-r, 2*r, 2*r)
+        elif self.dtype == DRAWRECTR:
+            path.addRoundedRect(x-r, y-r, 2*r, 2*r, 25.0, 25.0, mode=Qt.RelativeSize)
     
     def drawPolygonOnImage(self):
         if self.polygon.size() < 3 or not (self.foregroundImage and self.backgroundImage): return
-        painter = QPainter(self.foregroundImage)
-        painter.setPen(Qt.NoPen)
-        painter.setBrush(self.dbrush)
-        painter.drawPolygon(self.polygon)
-        painter.end()
+        path = QPainterPath()
+        path.addPolygon(self.polygon)
+        path.closeSubpath()
+        self.foregroundImage.setTool(QPen(Qt.NoPen), self.dbrush)
+        self.foregroundImage.drawPath(path, self.polygon.boundingRect().adjusted(-1, -1, 1, 1))
+        self.markDirty(self.polygon.boundingRect())
     # draw the current brush    
     def drawCursor(self, painter):
         painter.setPen(Qt.black)
@@ -337,6 +658,7 @@ class ObjectListScene(QGraphicsScene):
         super(ObjectListScene, self).__init__()
         self.main = main                            # main window
         self.backgroundImage = None
+        self.backgroundTiles = None
         self.setSceneRect(0, 0, WMIN, HMIN)
         self.objID = -1
         self.opacity = 0.6
@@ -392,19 +714,30 @@ class ObjectListScene(QGraphicsScene):
             self.deleteObject(item)
     
     # set the (background) image of the scene
-    def setImage(self, image):
+    # fullSize: (w, h) of the image, if 'image' is a reduced resolution version of it
+    # tiles: the TiledImage of 'image', if already made for another scene
+    def setImage(self, image, fullSize=None, tiles=None):
         if image:
-            self.backgroundImage = image.copy()
-            w,h = image.width(), image.height()
+            w,h = fullSize or (image.width(), image.height())
             self.setSceneRect(0, 0, w, h)
-            self.update()
+            self.setBackground(image, tiles)
         else:
             self.setSceneRect(0, 0, WMIN, HMIN)
+    # replace the background with a higher resolution version of the same image
+    def setBackground(self, image, tiles=None):
+        if image:
+            self.backgroundImage = image
+            self.backgroundTiles = tiles or TiledImage(image, self.sceneRect().width(), self.sceneRect().height())
+            self.update()
+    # scale from the background image to the scene, > 1 if the background has reduced resolution
+    def backgroundScale(self):
+        if not self.backgroundImage: return 1.0
+        return self.sceneRect().width() / self.backgroundImage.width()
     
     # overridden
     def drawBackground (self, painter, rect):
-        if self.backgroundImage:
-            painter.drawPixmap(0, 0, self.backgroundImage)
+        if self.backgroundTiles:
+            self.backgroundTiles.draw(painter, rect)
     
     def contextMenuEvent(self, event):
         item = self.itemAt(event.scenePos())
@@ -438,34 +771,112 @@ class ObjectListScene(QGraphicsScene):
             item.opacity = self.opacity
         self.update()
     
-class ImageTable(QTableWidget):
-    def __init__(self, rows, columns, main):
-        super(ImageTable, self).__init__(rows, columns, main)
+# Table model over the images of an Annotation: the rows are not stored, the data of a row
+# is read from the annotation only when the view asks for it (i.e. when the row is visible)
+class ImageTableModel(QAbstractTableModel):
+    HEADERS = ["image filename", "objects"]
+    #HEADERS = ["image filename", "objects", "label"]
+    
+    def __init__(self, parent=None):
+        super(ImageTableModel, self).__init__(parent)
+        self.ann = None
+        self.colors = {}        # (row, column) -> background color
+    
+    def setAnnotation(self, annotation):
+        self.beginResetModel()
+        self.ann = annotation
+        self.colors = {}
+        self.endResetModel()
+    
+    def rowCount(self, parent=QModelIndex()):
+        if self.ann is None or parent.isValid(): return 0
+        return self.ann.numImages()
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid(): return 0
+        return len(self.HEADERS)
+    
+    def text(self, row, column):
+        if column == 0: return self.ann.imageName(row)
+        elif not self.ann.image(row).labelsKnown: return ''      # not counted yet
+        else: return str(self.ann.numObjects(row))
+    def data(self, index, role=Qt.DisplayRole):
+        if self.ann is None or not index.isValid(): return QVariant()
+        if role == Qt.DisplayRole:
+            return QVariant(self.text(index.row(), index.column()))
+        elif role == Qt.BackgroundRole and (index.row(), index.column()) in self.colors:
+            return QVariant(QBrush(self.colors[(index.row(), index.column())]))
+        return QVariant()
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal and section < len(self.HEADERS):
+            return QVariant(self.HEADERS[section])
+        return QAbstractTableModel.headerData(self, section, orientation, role)
+    
+    def setBGColor(self, row, column, color):
+        self.colors[(row, column)] = QColor(color)
+        self.updateRow(row, column, column)
+    
+    # tell the views that (columns 'first' to 'last' of) a row changed
+    def updateRow(self, row, first=0, last=None):
+        self.updateRows(row, row, first, last)
+    def updateRows(self, firstRow, lastRow, first=0, last=None):
+        if last is None: last = self.columnCount() - 1
+        self.emit(SIGNAL('dataChanged(QModelIndex,QModelIndex)'), self.index(firstRow, first), self.index(lastRow, last))
+    
+    # append the images 'names' to the annotation, as new rows
+    def addImages(self, names):
+        n = self.rowCount()
+        self.beginInsertRows(QModelIndex(), n, n + len(names) - 1)
+        self.ann.addImages(names)
+        self.endInsertRows()
+
+# number of rows, at the start and at the end of the table, measured to size the columns
+COLUMN_SIZE_SAMPLES = 100
+
+class ImageTable(QTableView):
+    def __init__(self, main):
+        super(ImageTable, self).__init__(main)
         self.main = main
         self.ann = None
-        #self.setHorizontalHeaderLabels(["image filename", "objects", "label"])
-        self.setHorizontalHeaderLabels(["image filename", "objects"])
+        self.notify = True      # go to the image selected
+        self.tableModel = ImageTableModel(self)
+        self.setModel(self.tableModel)
+        # all rows have the same height, so the view does not measure every row
+        self.verticalHeader().setResizeMode(QHeaderView.Fixed)
+        self.verticalHeader().setDefaultSectionSize(self.fontMetrics().height() + 6)
         self.resizeColumnsToContents()
         self.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.setAlternatingRowColors(True)
         
-    def select(self, row, column):
+    # select a row, and go to its image unless 'notify' is False (the image is already shown)
+    def select(self, row, column, notify=True):
+        self.notify = notify
         self.clearSelection()
-        self.setCurrentCell(row, column)        
+        self.setCurrentIndex(self.tableModel.index(row, column))
+        self.notify = True
     
     def setBGColor(self, row, column, color):
-        item = self.item(row, column)
-        item.setBackgroundColor(color) 
+        self.tableModel.setBGColor(row, column, color)
     
-    def selectionChanged(self, selected, deselected):        
-        items = self.selectedItems()
+    def selectionChanged(self, selected, deselected):
+        super(ImageTable, self).selectionChanged(selected, deselected)
         rows = []
-        for item in items:
-            r,c = item.row(), item.column()            
+        for index in self.selectionModel().selectedIndexes():
+            r,c = index.row(), index.column()
             if c == 0 and r not in rows: rows.append(r)
-        if len(rows) == 1:      # only one row is selected, go to that image
+        if len(rows) == 1 and self.notify:      # only one row is selected, go to that image
             self.main.toImage(rows[0])
     
+    # size the columns to the text of the first and last rows only, instead of measuring every row
+    def resizeColumnsSampled(self):
+        n = self.tableModel.rowCount()
+        rows = range(min(n, COLUMN_SIZE_SAMPLES)) + range(max(COLUMN_SIZE_SAMPLES, n - COLUMN_SIZE_SAMPLES), n)
+        metrics = self.fontMetrics()
+        for column in range(self.tableModel.columnCount()):
+            width = metrics.width(self.tableModel.headerData(column, Qt.Horizontal).toString())
+            for row in rows:
+                width = max(width, metrics.width(self.tableModel.text(row, column)))
+            self.setColumnWidth(column, width + 12)
+    
 #    def contextMenuEvent(self, event):
 #        if not self.main.ann: return
 #        menu = QMenu()
@@ -492,33 +903,19 @@ class ImageTable(QTableWidget):
 #            print 'Image', index, 'label:', text
 #            self.updateTableRow(self.ann, index)            
     
-    # populate the table with the images
+    # show the images of the annotation; rows are read from it only when visible
     def updateTableView(self, annotation):
         if annotation is None: return
-        if annotation.numImages() > 0:
-            self.clearContents()
-            self.setRowCount(annotation.numImages())
-        
-        for i in range(annotation.numImages()):
-            self.updateTableRow(annotation, i)
-        
         self.ann = annotation
-        self.resizeColumnsToContents()
+        self.tableModel.setAnnotation(annotation)
+        self.resizeColumnsSampled()
     
     def updateTableRow(self, annotation, index):
         if annotation is None: return
-        nameItem = QTableWidgetItem(annotation.imageName(index))
-        numItem = QTableWidgetItem(str(annotation.numObjects(index)))
-        #labelItem = QTableWidgetItem(str(annotation.image(index).label))
-        self.setItem(index, 0, nameItem)
-        self.setItem(index, 1, numItem)
-        #self.setItem(index, 2, labelItem)
-        self.update()
+        self.tableModel.updateRow(index)
     def updateTableRowCol(self, annotation, row, col=1):
         if annotation is None: return        
-        numItem = QTableWidgetItem(str(annotation.numObjects(row)))        
-        self.setItem(row, col, numItem)
-        self.update()
+        self.tableModel.updateRow(row, col, col)
 
 class GraphicsView(QGraphicsView):
 
@@ -535,6 +932,12 @@ class GraphicsView(QGraphicsView):
         if event.modifiers() == Qt.ControlModifier:
             factor = 1.41 ** (event.delta() / 240.0)            
             self.scale(factor, factor)            
+            self.checkResolution()
+    
+    # load the full resolution image if the (reduced) background is shown at more than 1:1
+    def checkResolution(self):
+        if self.transform().m11() * self.scene.backgroundScale() > 1.0:
+            self.scene.main.loadFullResolution()
     
     def mouseDoubleClickEvent(self, event):
         self.fitOrResetView()
@@ -547,6 +950,7 @@ class GraphicsView(QGraphicsView):
             print 'Fit the image in view'
         else:
             self.resetTransform()
+            self.checkResolution()
             print 'Actual image size'
     
     def fitImageView(self):
@@ -565,6 +969,13 @@ class MainWindow(QMainWindow):
         # current image shown
         piximage = None
         self.startUp = True
+        self.prefetcher = ImagePrefetcher(PREFETCH_DEPTH)
+        self.writer = AnnotationWriter()
+        self.imageCache = ImageCache(IMAGE_CACHE_MB)
+        self.maskMemory = MaskMemory(MASK_MEMORY_MB)
+        self.scanner = None         # DirectoryScanner listing the image directory
+        self.scanFirst = None       # image shown as soon as found by the scanner (before the list is sorted)
+        self.fullResJob = None      # PrefetchJob decoding the current image at full resolution
         
         ## drawing scene and view on the left
         self.sceneDraw = ImageDrawScene(self)
@@ -582,7 +993,7 @@ class MainWindow(QMainWindow):
         self.viewList.setStatusTip('List of already selected objects')
         
         ## list of images
-        self.imageListTable = ImageTable(10, 2, self)
+        self.imageListTable = ImageTable(self)
         
         # text fields for class/subclass name
         imageDirLabel = QLabel("Image Directory:")
@@ -672,6 +1083,16 @@ class MainWindow(QMainWindow):
         ## status bar
         self.statusBar = QStatusBar(self)
         self.setStatusBar(self.statusBar)
+        # progress of the image directory scan
+        self.scanProgress = QProgressBar(self)
+        self.scanProgress.setMaximumWidth(250)
+        self.scanCancel = QPushButton("Cancel", self)
+        self.scanCancel.setStatusTip('Stop listing the image directory')
+        self.connect(self.scanCancel, SIGNAL('clicked()'), self.cancelScan)
+        self.statusBar.addPermanentWidget(self.scanProgress)
+        self.statusBar.addPermanentWidget(self.scanCancel)
+        self.scanProgress.hide()
+        self.scanCancel.hide()
         
         ### Layouts ### 
         # images & image list in the center
@@ -745,6 +1166,7 @@ class MainWindow(QMainWindow):
         self.setWindowIcon(QIcon('./icons/stat.png'))        
         
         self.statusMessage("ImAnT ready. Browse an image directory to get started [File/Ctrl-O]")
+        self.connect(self.writer, SIGNAL('error(QString)'), self.statusMessage)
             
     def createMenus(self):
         menuBar = self.menuBar()
@@ -770,6 +1192,14 @@ class MainWindow(QMainWindow):
         self.saveAll.setStatusTip("Save annotation list and current objects to default files")
         self.fileMenu.addAction(self.saveAll)
         
+        self.convertToDB = QAction("Convert annotations to database", self, triggered=functools.partial(self.convertAnnotations, 'sqlite'))
+        self.convertToDB.setStatusTip("Copy the .labels.txt and .png annotation files to a single SQLite database, and use it")
+        self.fileMenu.addAction(self.convertToDB)
+        
+        self.convertToFiles = QAction("Convert annotations to files", self, triggered=functools.partial(self.convertAnnotations, 'files'))
+        self.convertToFiles.setStatusTip("Copy the SQLite annotation database to .labels.txt and .png files, and use them")
+        self.fileMenu.addAction(self.convertToFiles)
+        
         #self.saveAnnAs = QAction("Save a copy of annotation list as..", self, triggered=self.saveAnnotationAs)
         #self.saveAnnAs.setStatusTip("Save a copy of annotation list to a specified file")
         #self.fileMenu.addAction(self.saveAnnAs)
@@ -811,21 +1241,81 @@ class MainWindow(QMainWindow):
     
     def onButtonSave(self):
         if self.ann is not None:
-            self.ann.saveCurrentObjectMasks(True)
-            self.ann.saveImageAnnAsTxt(True)
+            self.ann.saveCurrentAsync(self.writer, True)
             self.ann.toggleSave(False)
+            self.flushWriter()
+            self.ann.saveAnnotationList()
         else: print 'Nothing to save!'
     
+    # wait for the background writer to save all the queued annotations (unless cancelled by the user)
+    def flushWriter(self):
+        n = self.writer.pending()
+        if n == 0: return
+        progress = QProgressDialog("Saving annotations...", "Stop waiting", 0, n, self)
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(0)
+        while self.writer.pending() > 0:
+            if progress.wasCanceled():
+                self.statusMessage(str(self.writer.pending()) + ' annotations not saved yet')
+                return
+            progress.setValue(n - self.writer.pending())
+            QApplication.processEvents()
+            self.writer.wait(0.05)
+        progress.setValue(n)
+        QApplication.processEvents()
+    
     def onSaveBBox(self):
         if self.ann is not None:            
             self.ann.saveALLImageAnnAsBoxTxt(True)
             self.ann.toggleSave(False)
         else: print 'Nothing to save!'
     
+    # copy the annotations of the current directory to the storage 'backend' ('files' or 'sqlite') and switch to it
+    def convertAnnotations(self, backend):
+        if self.ann is None or self.ann.store is None: return
+        src = self.ann.store
+        if isinstance(src, SQLiteStore) == (backend == 'sqlite'):
+            self.statusMessage('The annotations are already stored as ' + backend)
+            return
+        self.onButtonSave()
+        self.cancelScan()
+        self.prefetcher.stop()      # nothing must read the old store anymore
+        annotationDir = self.ann.annotationDir
+        tmpname = annotationDir + ANNOTATION_DB + '.tmp'
+        if backend == 'sqlite':
+            # convert into a temporary database, moved in place only when complete
+            if not os.path.isdir(annotationDir): os.makedirs(annotationDir)
+            if os.path.exists(tmpname): os.remove(tmpname)
+            dst = SQLiteStore(annotationDir, ANNOTATION_DB + '.tmp')
+        else:
+            dst = FileStore(annotationDir)
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            n, errors = convertStore(src, dst)
+        except (IOError, OSError, sqlite3.Error) as e:
+            n, errors = 0, [str(e)]
+        finally:
+            QApplication.restoreOverrideCursor()
+            dst.close()
+        if errors:
+            if backend == 'sqlite': os.remove(tmpname)
+            QMessageBox.warning(self, "Convert annotations", '\n'.join(errors[:10]))
+            return
+        if backend == 'sqlite':
+            replaceFile(tmpname, annotationDir + ANNOTATION_DB)
+        else:
+            # keep the database, but out of the way: a directory with a database is opened as SQLite
+            src.close()
+            replaceFile(src.path, src.path + '.bak')
+        self.ann.store = openStore(annotationDir, backend)
+        self.statusMessage('Converted the annotations of ' + str(n) + ' images to ' + backend)
+    
     def closeEvent(self, event):
         ret = QMessageBox.question(self, "Exit application?", "Exit?", QMessageBox.Yes | QMessageBox.No)
         if ret == QMessageBox.Yes:
             print '\nSave current image and exit..'
+            self.cancelScan()
+            self.prefetcher.stop()
             self.onButtonSave()
         elif ret == QMessageBox.No:
             event.ignore()
@@ -887,55 +1377,156 @@ class MainWindow(QMainWindow):
         fileExt = fd.selectedNameFilter()
         
         # load the image file names from the selected directory
-        self.ann = Annotation()
-        self.ann.loadDir(fd.directory().absolutePath(), fd.selectedNameFilter())
+        self.prefetcher.cancel()
+        self.cancelScan()
+        self.maskMemory.clear()
+        self.ann = Annotation(writer=self.writer)
+        opened = self.ann.openDir(fd.directory().absolutePath(), fd.selectedNameFilter())
         self.startUp = True
         #self.updateImageDirText()
         self.updateDirectoriesText(self.ann.imageDir, self.ann.annotationDir)
         self.imageListTable.updateTableView(self.ann)
-        self.imageListTable.select(0,0)     # select and goto the first image       
+        if opened: self.imageListTable.select(self.ann.index, 0)     # select and goto the last visited image
+        if not self.ann.complete: self.startScan()      # not listed yet, or images added/removed since
+    
+    # list the image directory in the background, the first image is shown as soon as it is found
+    def startScan(self):
+        self.scanner = DirectoryScanner(self.ann.imageDir, self.ann.fex, self.ann.store, self.ann.manifestEntries)
+        for signal, slot in (('found(PyQt_PyObject)', self.onScanFound),
+                             ('listed(PyQt_PyObject)', self.onScanListed),
+                             ('counted(PyQt_PyObject)', self.onScanCounted),
+                             ('finished()', self.onScanFinished)):
+            self.connect(self.scanner, SIGNAL(signal), functools.partial(slot, self.scanner))
+        self.connect(self.scanner, SIGNAL('error(QString)'), self.statusMessage)
+        self.scanProgress.setRange(0, 0)        # busy until the number of images is known
+        self.scanProgress.show()
+        self.scanCancel.show()
+        self.statusMessage('Listing images...')
+        self.scanner.start()
+    def cancelScan(self):
+        if self.scanner is None: return
+        self.scanner.cancel()
+        self.scanner = None
+        self.scanProgress.hide()
+        self.scanCancel.hide()
+        self.statusMessage('Stopped listing images, ' + str(self.ann.numImages()) + ' images')
+    
+    # the signals of a cancelled (previous) scan are ignored
+    def onScanFound(self, scanner, names):
+        if scanner is not self.scanner: return
+        first = self.ann.numImages() == 0
+        self.imageListTable.tableModel.addImages(names)
+        self.statusMessage('Listing images... ' + str(self.ann.numImages()))
+        if first:
+            self.imageListTable.resizeColumnsSampled()
+            self.imageListTable.select(0, 0)
+            self.scanFirst = self.ann.curImage()
+    def onScanListed(self, scanner, names):
+        if scanner is not self.scanner: return
+        self.ann.sortImages(names)
+        self.imageListTable.updateTableView(self.ann)
+        # the first image found is in directory order: go to the first one in sorted order, unless the user moved
+        if self.ann.numImages() > 0 and self.ann.curImage() is self.scanFirst and self.ann.index != 0:
+            self.imageListTable.select(0, 0)
+        elif self.ann.numImages() > 0: self.imageListTable.select(self.ann.index, 0, False)
+        self.scanFirst = None
+        self.scanProgress.setRange(0, len(names))
+        self.scanProgress.setValue(0)
+        self.statusMessage('Counting objects in ' + str(len(names)) + ' images...')
+    def onScanCounted(self, scanner, counts):
+        if scanner is not self.scanner: return
+        self.ann.setCounts(counts)
+        self.imageListTable.tableModel.updateRows(counts[0][0], counts[-1][0], 1, 1)
+        self.scanProgress.setValue(counts[-1][0] + 1)
+    def onScanFinished(self, scanner):
+        if scanner is not self.scanner: return
+        self.scanner = None
+        self.scanProgress.hide()
+        self.scanCancel.hide()
+        self.statusMessage('Number of images loaded: ' + str(self.ann.numImages()))
+        self.ann.saveAnnotationList()
                
     def toImage(self, index):
         if self.ann is not None:
             if not self.startUp:
-                self.ann.saveCurrentObjectMasks()
-                self.ann.saveImageAnnAsTxt()
+                self.ann.saveCurrentAsync(self.writer)
                 self.ann.toggleSave(False)
-                #self.ann.deleteObjectMasks()
             index = self.ann.goto(index)
+            self.cancelFullResolution()
             self.ann.loadImageAnnAsTxt()
-            self.ann.loadObjectImages(index, self.brushColor, False)
+            image, masks = self.prefetcher.take(self.ann.curImagePath())
+            self.ann.loadObjectImages(index, self.brushColor, False, masks, self.imageCache)
+            self.maskMemory.touch(self.ann.curImage())
             self.imageListTable.updateTableRow(self.ann, self.ann.index)
             self.sceneList.clear()
-            self.showCurrentImage()
+            self.showCurrentImage(image)
             self.startUp = False
+            self.prefetcher.prefetchAround(self.ann, index, self.imageCache)
             print '\nImage', index+1
+            print 'Image cache:', self.imageCache.stats()
+            print 'Object masks:', self.maskMemory.stats()
             
-    # load the current image from disk and display it
-    def showCurrentImage(self):
+    # load the current image from the cache or disk (unless already decoded as 'image') and display it
+    def showCurrentImage(self, image=None):
         if self.ann is not None and self.ann.numImages() > 0:            
             imageFile = self.ann.curImagePath()
-            if os.path.exists(imageFile):
-                piximage = QPixmap(imageFile)
-                self.showImage(piximage)
+            key = imageCacheKey(imageFile)
+            if key is not None:
+                fullSize = None
+                if image is None: image = self.imageCache.get(key)
+                if image is None and REDUCED_DECODE:
+                    vsize = self.viewDraw.viewport().size()
+                    image, fullSize = decodeScaled(imageFile, max(vsize.width(), WMIN), max(vsize.height(), HMIN))
+                elif image is None: image = QImage(imageFile)
+                if fullSize is None: self.imageCache.put(key, image)
+                self.ann.curImage().size = fullSize or (image.width(), image.height())
+                self.showImage(image, fullSize)
             else:
                 print 'Image', imageFile, 'does not exits!'
     
-    def showImage(self, piximage):        
-        self.sceneList.setImage(piximage)
+    # image: QImage, drawn in tiles (see TiledImage)
+    def showImage(self, image, fullSize=None):        
+        w, h = fullSize or (image.width(), image.height())
+        tiles = TiledImage(image, w, h)     # one mipmap pyramid and tile cache for both scenes
+        self.sceneList.setImage(image, fullSize, tiles)
         self.sceneList.addObjects(self.ann.image(self.ann.index))
         self.viewList.fitImageView()
         self.sceneList.update()
-        self.sceneDraw.setImage(piximage)
+        self.sceneDraw.setImage(image, fullSize, tiles)
         self.viewDraw.fitImageView()
         self.sceneDraw.update()        
     
+    # decode the current image at full resolution in the background, if shown at reduced resolution
+    def loadFullResolution(self):
+        if self.ann is None or self.fullResJob is not None: return
+        if self.sceneDraw.backgroundScale() <= 1.0: return
+        print 'Loading the full resolution image..'
+        self.fullResJob = PrefetchJob(self.ann.curImagePath(), [])
+        self.prefetcher.pool.start(self.fullResJob)
+        QTimer.singleShot(50, self.checkFullResolution)
+    def checkFullResolution(self):
+        job = self.fullResJob
+        if job is None: return
+        if not job.done.is_set():
+            QTimer.singleShot(50, self.checkFullResolution)
+            return
+        self.fullResJob = None
+        if job.image is None or job.imagePath != self.ann.curImagePath(): return
+        self.imageCache.put(imageCacheKey(job.imagePath), job.image)
+        tiles = TiledImage(job.image, self.sceneDraw.w, self.sceneDraw.h)
+        self.sceneDraw.setBackground(job.image, tiles)
+        self.sceneList.setBackground(job.image, tiles)
+    def cancelFullResolution(self):
+        if self.fullResJob is not None:
+            self.fullResJob.cancel()
+            self.fullResJob = None
+    
     # add the selected object to the scene and to the list of annotations
     def addObject(self):
-        mask = self.sceneDraw.getObjectMask()       
-        x1,y1,w,h = getMBR_numpy(mask)
+        x1,y1,w,h = self.sceneDraw.getObjectMBR()
         if x1 < 0: return
-        objImg = self.sceneDraw.foregroundImage.copy(x1, y1, w, h)
+        mask = self.sceneDraw.getObjectMask(QRect(x1, y1, w, h))
+        objImg = self.sceneDraw.getObjectImage(QRect(x1, y1, w, h))
         self.sceneList.addObjectImage(objImg, x1, y1)
         self.sceneDraw.resetForeground()        
         
@@ -949,7 +1540,7 @@ class MainWindow(QMainWindow):
         else:
             self.currentLabelText.setText("__none__");
         #self.ann.addObject(mask, objImg, x1, y1, self.sceneList.objID, w, h, utfText)
-        self.ann.addObject(mask, objImg, x1, y1, self.sceneList.objID, w, h, text)
+        self.ann.addObject(mask, objImg, x1, y1, self.sceneList.objID, w, h, str(text.toUtf8()))
         #self.imageListTable.updateTableRow(self.ann, self.ann.index)
         self.imageListTable.updateTableRowCol(self.ann, self.ann.index)
     
@@ -960,7 +1551,7 @@ class MainWindow(QMainWindow):
         if ok:
             print 'Object', self.sceneList.objID, 'new label:', text.toUtf8()
             self.currentLabelText.setText(text);
-            self.ann.images[self.ann.index].setObjectText(objID, text)
+            self.ann.images[self.ann.index].setObjectText(objID, str(text.toUtf8()))
         else:
             print 'Object', objID, 'label not updated.'
             return
@@ -970,14 +1561,14 @@ class MainWindow(QMainWindow):
             self.currentLabelText.setText("__none__")
             return
         text = self.ann.curImage().getObjectText(item.ID)        
-        self.currentLabelText.setText(text);
+        self.currentLabelText.setText(QString.fromUtf8(text));
         #print 'updateSelectedLabel:', text.copy().toUtf8()
     
     def updateSelectedObjectLabel(self):        
         items = self.sceneList.selectedItems()
         if len(items)==0:            
             return
-        text = self.currentLabelText.text()
+        text = str(self.currentLabelText.text().toUtf8())
         for item in items:            
             self.ann.images[self.ann.index].setObjectText(item.ID, text)
             print 'Object ', item.ID, 'label updated.'
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Benchmarks of the annotation code (Ann.py), without the GUI:
+#   python bench.py [name ...] > bench_output.txt
+# runs the named benchmarks (all of them by default), see BENCHMARKS
+
+import sys
+import os
+import gc
+import time
+import shutil
+import collections
+import tempfile
+import numpy
+from PyQt4.QtGui import *
+import Ann
+from Ann import *
+
+# best time (seconds) of 'repeat' runs of func(*args), and its result
+def timeRuns(repeat, func, *args):
+    best, result = float('inf'), None
+    for i in range(repeat):
+        t = time.time()
+        result = func(*args)
+        best = min(best, time.time() - t)
+    return best, result
+
+# object mask as given by ImageDrawScene (alphaChannel(): 8-bit, gray ramp color table), w x h pixels
+# with a rectangle of foreground pixels around the center
+def maskImage(w, h):
+    qimage = QImage(w, h, QImage.Format_Indexed8)
+    qimage.setColorTable([qRgb(i, i, i) for i in range(256)])
+    arr = qimage2numpy(qimage, True)
+    arr[:] = 0
+    arr[h/3:h/2, w/4:w*3/5] = 255
+    return qimage
+
+# getMBR_pixel (per pixel loop) vs getMBR_numpy, at 1, 12 and 50 megapixels
+# (the pixel loop takes minutes at 50 MP)
+def benchMBR():
+    print 'MBR of an object mask: getMBR_pixel vs getMBR_numpy'
+    for mp, w, h in [(1, 1152, 864), (12, 4000, 3000), (50, 8192, 6144)]:
+        qimage = maskImage(w, h)
+        tpixel, mbr = timeRuns(1, getMBR_pixel, qimage)
+        tnumpy, mbr2 = timeRuns(5, getMBR_numpy, qimage)
+        assert mbr == mbr2, (mbr, mbr2)
+        print '%3d MP: pixel %9.3f s, numpy %7.4f s, %8.0fx' % (mp, tpixel, tnumpy, tpixel / max(tnumpy, 1e-9))
+    print
+
+# XImage ids: add n objects with getID, delete every other one, then add them again (reusing the
+# freed ids); fails if an operation costs more than MAX_ID_RATIO times more with 10k objects than with
+# 1k (O(1)/O(log n) operations stay well below; an O(n) scan makes it about 10)
+MAX_ID_RATIO = 3.0
+# seconds per operation (add, delete, add with freed ids) with n objects
+def timeIDs(n):
+    ximg = XImage('bench.jpg')
+    t = time.time()
+    for i in range(n):
+        ximg.appendObject(Object(id=ximg.getID()))
+    tadd = time.time() - t
+    t = time.time()
+    for id in range(0, n, 2):
+        ximg.deleteObject(id)
+    tdelete = time.time() - t
+    t = time.time()
+    for i in range(0, n, 2):
+        ximg.appendObject(Object(id=ximg.getID()))
+    treuse = time.time() - t
+    assert sorted(ximg.indexByID.keys()) == range(n)
+    return tadd / n, tdelete * 2 / n, treuse * 2 / n
+def benchIDs():
+    print 'Object ids of an XImage: microseconds per operation (best of 5)'
+    times = {}
+    for n in [1000, 10000]:
+        runs = [timeIDs(n) for i in range(5)]
+        times[n] = [min(t) for t in zip(*runs)]
+        print '%6d objects: add %6.2f, delete %6.2f, add with freed ids %6.2f' % (n,
+                times[n][0] * 1e6, times[n][1] * 1e6, times[n][2] * 1e6)
+    for name, t1k, t10k in zip(('add', 'delete', 'add with freed ids'), times[1000], times[10000]):
+        ratio = t10k / max(t1k, 1e-9)
+        assert ratio <= MAX_ID_RATIO, '%s: %.1f times slower per object with 10k objects than with 1k' % (name, ratio)
+    print
+
+# resident memory of the process (bytes), from /proc on Linux, else the peak from getrusage
+def residentBytes():
+    try:
+        ifs = open('/proc/self/statm')
+        pages = int(ifs.read().split()[1])
+        ifs.close()
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Object as it was before the slots: a __dict__ per instance, the label as a QString
+class DictObject:
+    def __init__(self, mask=None, region=None, x1=0, y1=0, id=0, w=0, h=0, text=None):
+        self.region = region
+        self.x1, self.y1, self.w, self.h = x1, y1, w, h
+        self.mask = mask
+        self.text = QString(unicode(text, 'utf8'))
+        self.id = id
+        self.saveMask = True
+
+# memory of n objects parsed from .labels.txt lines (as XImage.loadTxtFile), with labels from a
+# vocabulary of 1000 words: bytes per object of the old objects (DictObject) and of Object
+def benchMemory(n=1000000):
+    print 'Memory of %d objects: bytes per object' % n
+    lines = ['%d %d %d %d %d word%d' % (i % 300, i % 640, i % 480, 20, 10, i % 1000) for i in range(n)]
+    for name, cls in [('before (dict, QString)', DictObject), ('after (slots, interned str)', Object)]:
+        gc.collect()
+        rss = residentBytes()
+        objects = []
+        for line in lines:
+            sline = line.split()
+            objects.append(cls(None, None, int(sline[1]), int(sline[2]), int(sline[0]),
+                               int(sline[3]), int(sline[4]), ' '.join(sline[5:])))
+        print '%-28s %6.0f' % (name, float(residentBytes() - rss) / n)
+        del objects
+        LABELS.clear()
+    print
+
+# n object masks (RLEMask) of w x h pixels, a filled ellipse each
+def ellipseMasks(n, w, h):
+    y, x = numpy.ogrid[:h, :w]
+    masks = []
+    for i in range(n):
+        rx, ry = w * (0.3 + 0.2 * (i % 5) / 4.0), h * (0.3 + 0.2 * (i % 3) / 2.0)
+        fg = ((x - w / 2.0) / rx) ** 2 + ((y - h / 2.0) / ry) ** 2 <= 1
+        masks.append(RLEMask.fromArray(fg.astype(numpy.uint8)))
+    return masks
+
+# saving the masks of an image with encodeMasks (MASK_SAVE_THREADS threads), per codec and PNG
+# compression level: masks per second, MB of mask pixels per second, and bytes per mask on the disk
+def benchCodecs(n=200, w=400, h=300):
+    print 'Encoding %d masks of %dx%d pixels with %d threads' % (n, w, h, MASK_SAVE_THREADS)
+    masks = ellipseMasks(n, w, h)
+    tmpdir = tempfile.mkdtemp()
+    codec, compression = Ann.MASK_CODEC, Ann.MASK_COMPRESSION
+    try:
+        for name, level in [('png', -1), ('png', 0), ('png', 1), ('png', 6), ('png', 9), ('npy', None), ('bits', None)]:
+            Ann.MASK_CODEC, Ann.MASK_COMPRESSION = name, level
+            items = [(os.path.join(tmpdir, str(i) + MASK_EXTENSIONS[name]), masks[i]) for i in range(n)]
+            t, encoded = timeRuns(3, encodeMasks, items)
+            assert len(encoded) == n
+            size = sum(os.path.getsize(fname + '.tmp') for fname, mask in items)
+            if level is None: level = '-'
+            print '%-5s level %2s: %8.0f masks/s, %7.1f MB/s, %7.0f bytes/mask' % (name, level,
+                    n / t, n * w * h / t / 1048576.0, float(size) / n)
+    finally:
+        Ann.MASK_CODEC, Ann.MASK_COMPRESSION = codec, compression
+        shutil.rmtree(tmpdir)
+    print
+
+BENCHMARKS = collections.OrderedDict([
+    ('mbr', benchMBR),
+    ('ids', benchIDs),
+    ('memory', benchMemory),
+    ('codecs', benchCodecs),
+])
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or BENCHMARKS.keys()
+    for name in names:
+        BENCHMARKS[name]()